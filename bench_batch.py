@@ -0,0 +1,122 @@
+"""
+Benchmark: relay throughput for bots, with and without OPT:batch.
+
+Starts server.py and runs pairs of bots through it. The sender of each
+pair writes --messages short lines one send() at a time, as fast as the
+server takes them; the receiver counts MSG: lines until all have arrived.
+Reported per mode: messages a second, and messages a second for each
+second of server CPU (utime + stime from /proc), i.e. per core.
+
+    python bench_batch.py
+    python bench_batch.py --pairs 8 --messages 100000 --batch-delay 1000
+
+Needs /proc (Linux) for the CPU figure.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+from loadgen import client, spawn_server, stop_server, until
+
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def receive(reader, count, failed):
+    try:
+        left, tail = count, b""
+        while left > 0:
+            data = reader.read1(65536)
+            if not data:
+                raise EOFError(f"{left} messages missing")
+            data = tail + data
+            left -= data.count(b"MSG:")
+            tail = data[-3:]  # too short to hold a whole MSG: of its own
+    except (OSError, EOFError) as e:
+        failed.append(repr(e))
+
+
+def run_pair(args, i, batch, ready, go, failed):
+    room = f"BB{i}"
+    try:
+        opts = ("batch",) if batch else ()
+        a, a_in = client(args, "bot", room, opts)
+        until(a_in, b"SYS:Room closes")
+        b, b_in = client(args, "sink", room, opts)
+        until(b_in, b"CONNECTED:")
+        until(a_in, b"CONNECTED:")
+    except (OSError, EOFError) as e:
+        failed.append(repr(e))
+        ready.wait()
+        return
+    sink = threading.Thread(target=receive, args=(b_in, args.messages, failed))
+    sink.start()
+    ready.wait()
+    go.wait()
+    try:
+        line = b"tick 0123456789\n"
+        for _ in range(args.messages):
+            a.sendall(line)
+    except OSError as e:
+        failed.append(repr(e))
+    sink.join()
+    a.close()
+    b.close()
+
+
+def bench(args, batch):
+    args.server_args = f"--engine {args.engine} --batch-delay {args.batch_delay}"
+    proc = spawn_server(args)
+    failed = []
+    ready = threading.Barrier(args.pairs + 1)
+    go = threading.Event()
+    try:
+        threads = [threading.Thread(target=run_pair, args=(args, i, batch, ready, go, failed))
+                   for i in range(args.pairs)]
+        for t in threads:
+            t.start()
+        ready.wait()
+        cpu, start = cpu_seconds(proc.pid), time.perf_counter()
+        go.set()
+        for t in threads:
+            t.join()
+        wall, cpu = time.perf_counter() - start, cpu_seconds(proc.pid) - cpu
+    finally:
+        stop_server(proc)
+    return args.pairs * args.messages, wall, cpu, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bot throughput with and without OPT:batch")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default="threads")
+    parser.add_argument("--pairs", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--batch-delay", type=float, default=500, metavar="USECS")
+    args = parser.parse_args()
+
+    print(f"[*] {args.pairs} pairs x {args.messages} messages, {args.engine} engine, "
+          f"batch delay {args.batch_delay:g} us")
+    print(f"{'mode':>6}  {'msgs/s':>10}  {'cpu s':>7}  {'msgs/s/core':>12}")
+    status = 0
+    for batch in (False, True):
+        mode = "batch" if batch else "plain"
+        count, wall, cpu, failed = bench(args, batch)
+        if failed:
+            print(f"[-] {mode}: {len(failed)} failures, e.g. {failed[0]}")
+            status = 1
+            continue
+        per_core = f"{count / cpu:,.0f}" if cpu else "-"
+        print(f"{mode:>6}  {count / wall:>10,.0f}  {cpu:>7.2f}  {per_core:>12}")
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Microbenchmark: line framing throughput, old split-the-buffer loop vs
+framing.LineFramer, for 1 KB, 64 KB and 1 MB lines arriving in 1024-byte
+recv() chunks like relay() sees them.
+
+    python bench_framing.py
+"""
+
+import time
+
+from framing import LineFramer
+
+CHUNK = 1024
+SIZES = [("1 KB", 1 << 10), ("64 KB", 1 << 16), ("1 MB", 1 << 20)]
+TOTAL = 8 << 20  # bytes pushed through per run
+
+
+def old_relay_split(chunks):
+    """The loop relay() used before LineFramer."""
+    n = 0
+    buf = b""
+    for chunk in chunks:
+        buf += chunk
+        while b"\n" in buf:
+            line, buf = buf.split(b"\n", 1)
+            n += 1
+    return n
+
+
+def framer_split(chunks):
+    n = 0
+    framer = LineFramer(max_line=2 << 20)
+    for chunk in chunks:
+        n += len(framer.feed(chunk))
+    return n
+
+
+def make_chunks(line_size):
+    line = b"x" * (line_size - 1) + b"\n"
+    data = line * max(1, TOTAL // line_size)
+    return [data[i:i + CHUNK] for i in range(0, len(data), CHUNK)], len(data)
+
+
+def bench(fn, chunks, nbytes):
+    best = float("inf")
+    for _ in range(3):
+        t = time.perf_counter()
+        fn(chunks)
+        best = min(best, time.perf_counter() - t)
+    return nbytes / best / 1e6
+
+
+def main():
+    print(f"{'line':>6}  {'old MB/s':>10}  {'framer MB/s':>12}  {'speedup':>8}")
+    for label, size in SIZES:
+        chunks, nbytes = make_chunks(size)
+        assert old_relay_split(chunks) == framer_split(chunks)
+        old = bench(old_relay_split, chunks, nbytes)
+        new = bench(framer_split, chunks, nbytes)
+        print(f"{label:>6}  {old:>10.1f}  {new:>12.1f}  {new / old:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
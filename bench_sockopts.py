@@ -0,0 +1,94 @@
+"""
+Benchmark: message-path latency under each --tcp-profile.
+
+Starts server.py once per profile and runs pairs through it. Each round,
+one side sends two short lines as two separate writes and the other
+answers once it has both; that is a person typing quickly, and exactly
+the case where Nagle holds the second MSG: line until the first is
+acknowledged. Client sockets have Nagle off, so any delay is the server's.
+
+    python bench_sockopts.py
+    python bench_sockopts.py --profiles os chat --pairs 20 --rounds 500
+
+The asyncio engine turns Nagle off on its own, so the difference shows on
+the thread engine (the default here).
+"""
+
+import argparse
+import sys
+import threading
+import time
+
+from loadgen import client, percentile, spawn_server, stop_server, until
+from sockopts import PROFILES
+
+
+def run_pair(args, i, rounds, failed):
+    room = f"BS{i}"
+    try:
+        a, a_in = client(args, "a", room, timeout=10)
+        until(a_in, b"SYS:Room closes")
+        b, b_in = client(args, "b", room, timeout=10)
+        until(b_in, b"CONNECTED:")
+        until(a_in, b"CONNECTED:")
+        for n in range(args.rounds + 1):
+            t = time.perf_counter()
+            a.sendall(b"one\n")
+            a.sendall(b"two\n")
+            until(b_in, b"MSG:a:two")
+            b.sendall(b"ok\n")
+            until(a_in, b"MSG:b:ok")
+            if n:  # the first round warms the pair up
+                rounds.append(time.perf_counter() - t)
+        a.sendall(b"/quit\n")
+        a.close()
+        b.close()
+    except (OSError, EOFError) as e:
+        failed.append(repr(e))
+
+
+def bench(args, profile):
+    args.server_args = f"--engine {args.engine} --tcp-profile {profile}"
+    proc = spawn_server(args)
+    rounds, failed = [], []
+    try:
+        threads = [threading.Thread(target=run_pair, args=(args, i, rounds, failed))
+                   for i in range(args.pairs)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        stop_server(proc)
+    return sorted(rounds), failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="latency per --tcp-profile")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default="threads")
+    parser.add_argument("--profiles", nargs="+", default=sorted(PROFILES),
+                        choices=sorted(PROFILES))
+    parser.add_argument("--pairs", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=500)
+    args = parser.parse_args()
+
+    ms = lambda v: f"{v * 1000:.3f}"
+    print(f"[*] {args.pairs} pairs x {args.rounds} rounds, {args.engine} engine: "
+          "two lines out, one back")
+    print(f"{'profile':>8}  {'p50 ms':>8}  {'p99 ms':>8}  {'p99.9 ms':>9}  {'max ms':>8}")
+    status = 0
+    for profile in args.profiles:
+        rounds, failed = bench(args, profile)
+        if failed:
+            print(f"[-] {profile}: {len(failed)} pairs failed, e.g. {failed[0]}")
+            status = 1
+            continue
+        print(f"{profile:>8}  {ms(percentile(rounds, 50)):>8}  {ms(percentile(rounds, 99)):>8}  "
+              f"{ms(percentile(rounds, 99.9)):>9}  {ms(rounds[-1]):>8}")
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Non-blocking event log for server.py.
+
+info()/warning()/error() only append to a bounded in-memory ring and
+return; a background thread writes whatever has piled up in one batch, so
+a slow terminal or pipe stalls that thread instead of a relay or the accept
+loop. If the writer falls that far behind the ring drops its oldest lines
+(and says how many), and an event type logged more than RATE times in a
+second is summarised rather than written line by line.
+
+Lines come out as before ("[+] Connection from ...") or, with
+FORMAT = "json", as one JSON object per line:
+
+    {"ts": 1700000000.123456, "level": "info", "event": "connect",
+     "msg": "Connection from ('127.0.0.1', 50000)", "addr": ["127.0.0.1", 50000]}
+"""
+
+import atexit
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+FORMAT    = "text"   # or "json"
+RING_SIZE = 10000    # lines waiting for the writer before the oldest go
+RATE      = 100      # lines per event type per second before summarising
+
+_lock       = threading.Lock()
+_write_lock = threading.Lock()  # keeps batches in order between writer and flush()
+_wake       = threading.Event()
+_ring       = collections.deque(maxlen=RING_SIZE)
+_dropped    = 0
+_window     = 0.0    # start of the current rate-limit second
+_seen       = {}     # event -> lines logged in this window
+_suppressed = {}     # event -> lines held back in this window
+_writer     = None
+
+
+def info(event, text, **fields):
+    _log("info", event, text, fields)
+
+
+def warning(event, text, **fields):
+    _log("warning", event, text, fields)
+
+
+def error(event, text, **fields):
+    _log("error", event, text, fields)
+
+
+def _log(level, event, text, fields):
+    global _dropped
+    now = time.time()
+    with _lock:
+        was_empty = not _ring
+        if now - _window >= 1:
+            _roll_window(now)
+        seen = _seen.get(event, 0)
+        _seen[event] = seen + 1
+        if seen >= RATE:
+            _suppressed[event] = _suppressed.get(event, 0) + 1
+            if was_empty and _ring:
+                _wake.set()     # the roll queued summaries
+            return
+        if len(_ring) == RING_SIZE:
+            _dropped += 1
+        _ring.append((now, level, event, text, fields))
+        if _writer is None:
+            _start()
+    if was_empty:
+        _wake.set()
+
+
+def _roll_window(now):
+    """Close the rate-limit second: queue a summary per suppressed event."""
+    global _window
+    for event, n in _suppressed.items():
+        _ring.append((now, "warning", "suppressed",
+                      f"[!] {n} more {event!r} lines suppressed in the last second",
+                      {"of": event, "count": n}))
+    _suppressed.clear()
+    _seen.clear()
+    _window = now
+
+
+def _format(entry):
+    ts, level, event, text, fields = entry
+    if FORMAT != "json":
+        return text + "\n"
+    msg = text.strip()
+    if msg.startswith("["):
+        msg = msg.split("]", 1)[1].strip()
+    record = {"ts": round(ts, 6), "level": level, "event": event, "msg": msg}
+    record.update(fields)
+    return json.dumps(record, default=str) + "\n"
+
+
+def _start():
+    global _writer
+    _writer = threading.Thread(target=_run, name="eventlog", daemon=True)
+    _writer.start()
+
+
+def _run():
+    while True:
+        # Wake up once a second while lines are held back so their summary
+        # is written even if nothing else gets logged.
+        _wake.wait(1.0 if _suppressed else None)
+        _wake.clear()
+        _drain()
+
+
+def _drain():
+    global _dropped
+    with _write_lock:
+        with _lock:
+            if _suppressed and time.time() - _window >= 1:
+                _roll_window(time.time())
+            batch = list(_ring)
+            _ring.clear()
+            dropped, _dropped = _dropped, 0
+        if not batch and not dropped:
+            return
+        lines = [_format(entry) for entry in batch]
+        if dropped:
+            lines.append(_format((time.time(), "warning", "dropped",
+                                  f"[!] {dropped} log lines dropped; the log writer fell behind",
+                                  {"count": dropped})))
+        try:
+            sys.stdout.write("".join(lines))
+            sys.stdout.flush()
+        except (OSError, ValueError):
+            pass  # stdout closed or gone; nothing sensible left to do
+
+
+def flush():
+    """Write out everything logged so far, on the calling thread."""
+    _drain()
+
+
+def _after_fork():
+    # The writer thread doesn't survive fork(); the child starts its own.
+    global _writer, _lock, _write_lock, _wake
+    _lock       = threading.Lock()
+    _write_lock = threading.Lock()
+    _wake       = threading.Event()
+    _writer     = None
+    _ring.clear()
+
+
+atexit.register(flush)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,293 @@
+"""
+Wire framing helpers shared by both server engines.
+"""
+
+import zlib
+
+MAX_LINE = 1 << 20  # longest chat line accepted before the sender is cut off
+
+
+class LineTooLong(ValueError):
+    pass
+
+
+class LineFramer:
+    """
+    Incremental line splitter; also the per-connection read buffer.
+
+    Bytes are appended to a bytearray and only the part not looked at yet is
+    scanned, so a long line arriving in many small chunks costs linear time
+    instead of re-splitting the whole buffer on every recv. Lines come back
+    without their terminator. With cr=True a lone "\\r" also ends a line and
+    "\\r\\n" counts once, matching what telnet-style clients send.
+
+    Either feed() chunks and take every complete line, or push() them and
+    pull one line at a time with next_line(); whatever has not been pulled
+    yet is still there in pending(), e.g. for the next reader of the socket.
+    Lines from feed() that the caller can't take yet go back with defer().
+
+    Raises LineTooLong on a line longer than max_line bytes, whether it came
+    whole in one chunk or is still pending without a terminator.
+    """
+
+    def __init__(self, max_line=MAX_LINE, cr=False):
+        self.max_line = max_line
+        self.cr       = cr
+        self.buf      = bytearray()
+        self.start    = 0       # first byte not handed out yet
+        self.scan     = 0       # buf[start:scan] holds no terminator
+        self.skip_lf  = False   # last line ended in "\r"; drop a leading "\n"
+        self.received = 0       # bytes fed in so far
+        self.deferred = []      # lines handed back by defer()
+
+    def defer(self, lines):
+        """Hand back lines from the last feed(); the next one returns them first."""
+        self.deferred = lines
+
+    def feed(self, data):
+        """Add data and return all complete lines now available."""
+        lines, self.deferred = self.deferred, []
+        if self.cr:
+            self.push(data)
+            line = self.next_line()
+            while line is not None:
+                lines.append(line)
+                line = self.next_line()
+            return lines
+
+        # Fast path for "\n"-only framing: push() and the next_line() loop
+        # inlined, since this runs once per recv() in relay().
+        buf = self.buf
+        if self.start:
+            del buf[:self.start]
+            self.scan -= self.start
+        buf += data
+        self.received += len(data)
+        start = 0
+        end   = buf.find(b"\n", self.scan)
+        max_line = self.max_line
+        while end >= 0:
+            if end - start > max_line:
+                raise LineTooLong(f"line exceeds {max_line} bytes")
+            lines.append(bytes(buf[start:end]))
+            start = end + 1
+            end = buf.find(b"\n", start)
+        self.start = start
+        self.scan  = len(buf)
+        if self.scan - start > self.max_line:
+            raise LineTooLong(f"line exceeds {self.max_line} bytes")
+        return lines
+
+    def push(self, data):
+        if self.start:
+            del self.buf[:self.start]
+            self.scan -= self.start
+            self.start = 0
+        self.buf += data
+        self.received += len(data)
+
+    def next_line(self):
+        """Pop the next complete line, or None if there is none yet."""
+        buf   = self.buf
+        start = self.start
+        if self.skip_lf and start < len(buf):
+            self.skip_lf = False
+            if buf[start] == 0x0A:
+                start += 1
+                self.start = start
+                self.scan  = max(self.scan, start)
+
+        end = buf.find(b"\n", self.scan)
+        if self.cr:
+            cr = buf.find(b"\r", self.scan, len(buf) if end < 0 else end)
+            if cr >= 0:
+                end = cr
+        if end < 0:
+            self.scan = len(buf)
+            if self.scan - start > self.max_line:
+                raise LineTooLong(f"line exceeds {self.max_line} bytes")
+            return None
+
+        if end - start > self.max_line:
+            raise LineTooLong(f"line exceeds {self.max_line} bytes")
+        line = bytes(buf[start:end])
+        self.skip_lf = buf[end] == 0x0D
+        self.start = self.scan = end + 1
+        return line
+
+    def pending(self):
+        """Bytes received but not returned (or deferred) as a line yet."""
+        data = bytes(self.buf[self.start:])
+        if self.skip_lf and data[:1] == b"\n":
+            data = data[1:]
+        if self.deferred:
+            data = b"".join(line + b"\n" for line in self.deferred) + data
+        return data
+
+
+# ── binary framing (OPT:binary) ──
+#
+#   frame  = varint(len(type + body)) type body
+#   varint = unsigned LEB128: 7 bits a byte, lowest first, high bit set on
+#            every byte but the last
+#
+# A client sends MSG frames (any bytes, newlines included) and QUIT. The
+# server sends MSG frames as varint(len(name)) name message, and every other
+# protocol line (SYS:...) as a LINE frame holding the line without "\n".
+#
+# With OPT:deflate a client may also send and receive ZMSG frames: a MSG
+# whose message is compressed on its own (raw deflate, no context carried
+# between messages) against the preset dictionary ZDICT, so the server can
+# hand one sender's compressed bytes to any number of receivers untouched.
+
+FRAME_LINE = 0
+FRAME_MSG  = 1
+FRAME_QUIT = 2
+FRAME_ZMSG = 3
+
+# What pasted logs and stack traces are made of; the likeliest strings last.
+ZDICT = (
+    b"https://http://localhost:127.0.0.1 0x00000000 null None undefined true false "
+    b"WARNING WARN CRITICAL FATAL SEVERE TRACE DEBUG INFO ERROR "
+    b"    at java.lang.Thread.run(Thread.java:  at java.base/ Caused by: "
+    b"java.lang.NullPointerException java.lang.IllegalStateException "
+    b"Exception in thread \"main\" ... more\n"
+    b"KeyError: ValueError: TypeError: AttributeError: RuntimeError: "
+    b"ImportError: ModuleNotFoundError: IndexError: AssertionError: "
+    b"During handling of the above exception, another exception occurred:\n"
+    b"The above exception was the direct cause of the following exception:\n"
+    b"  File \"/usr/lib/python3/site-packages/  File \"/home/"
+    b"\n    raise \n    return self.\n    ^^^^^^^^\n"
+    b"Traceback (most recent call last):\n  File \""
+    b"\", line , in <module>\n\", line , in \n    "
+    b"2024-01-01T00:00:00.000Z 2025-01-01 00:00:00,000 "
+    b" ERROR  INFO  DEBUG  WARNING [main] [INFO] [ERROR] "
+)
+
+
+class BadFrame(ValueError):
+    pass
+
+
+_SHORT = [bytes((n,)) for n in range(0x80)]
+
+
+def varint(n):
+    if n < 0x80:
+        return _SHORT[n]
+    out = bytearray()
+    while n > 0x7F:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def frame(ftype, body=b""):
+    """Header and body of a frame, as two buffers for a gather write."""
+    return varint(len(body) + 1) + bytes((ftype,)), body
+
+
+def msg_prefix(name, ftype=FRAME_MSG):
+    """What goes between a MSG (or ZMSG) frame's length and the message."""
+    name = name.encode()
+    return bytes((ftype,)) + varint(len(name)) + name
+
+
+def split_msg(body):
+    """(name, message) out of the body of a MSG or ZMSG frame."""
+    n = shift = i = 0
+    while True:
+        byte = body[i]
+        i += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    return body[i:i + n], body[i + n:]
+
+
+def deflate(data, level=6):
+    """A ZMSG message body for data."""
+    z = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=ZDICT)
+    return z.compress(data) + z.flush()
+
+
+def inflate(body, max_size=MAX_LINE):
+    """Undo deflate(); raises BadFrame past max_size bytes or on bad data."""
+    z = zlib.decompressobj(-15, zdict=ZDICT)
+    try:
+        data = z.decompress(body, max_size)
+    except zlib.error as e:
+        raise BadFrame(f"bad compressed message: {e}") from None
+    if z.unconsumed_tail:
+        raise BadFrame(f"message inflates past {max_size} bytes")
+    return data
+
+
+def line_frames(data):
+    """Protocol lines (b"SYS:...\\n" and so on) as LINE frame buffers."""
+    bufs = []
+    for line in data.splitlines():
+        bufs.extend(frame(FRAME_LINE, line))
+    return bufs
+
+
+class FrameDecoder:
+    """
+    Incremental splitter for binary frames, with LineFramer's feed() /
+    defer() / pending() interface. Only the length prefix is parsed; bodies are
+    sliced out whole and never scanned.
+
+    Raises BadFrame for an empty frame or one over max_frame bytes.
+    """
+
+    def __init__(self, max_frame=MAX_LINE):
+        self.max_frame = max_frame
+        self.buf       = bytearray()
+        self.received  = 0
+        self.deferred  = []
+
+    def defer(self, frames):
+        """Hand back frames from the last feed(); the next one returns them first."""
+        self.deferred = frames
+
+    def feed(self, data):
+        """Add data and return (type, body) for every complete frame."""
+        buf = self.buf
+        buf += data
+        self.received += len(data)
+        end = len(buf)
+        pos = 0
+        frames, self.deferred = self.deferred, []
+        with memoryview(buf) as view:
+            while pos < end:
+                size = shift = 0
+                i = pos
+                while i < end:
+                    byte = buf[i]
+                    i += 1
+                    size |= (byte & 0x7F) << shift
+                    if byte < 0x80:
+                        break
+                    shift += 7
+                    if shift > 35:
+                        raise BadFrame("malformed length")
+                else:
+                    break  # the length isn't all here yet
+                if not size:
+                    raise BadFrame("empty frame")
+                if size > self.max_frame:
+                    raise BadFrame(f"frame exceeds {self.max_frame} bytes")
+                if end - i < size:
+                    break
+                frames.append((buf[i], bytes(view[i + 1:i + size])))
+                pos = i + size
+        if pos:
+            del buf[:pos]
+        return frames
+
+    def pending(self):
+        """Bytes received but not returned (or deferred) as a frame yet."""
+        held = [buf for ftype, body in self.deferred for buf in frame(ftype, body)]
+        return b"".join(held) + bytes(self.buf)
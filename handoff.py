@@ -0,0 +1,150 @@
+"""
+Zero-downtime restarts for server.py (--handoff PATH).
+
+A running server offers its listening socket on the unix socket PATH. A new
+server started with the same --handoff PATH connects there first, receives
+the listening socket (SCM_RIGHTS) and accepts on it straight away, so no
+connection attempt is refused during a deploy. The old process then
+drains: it passes over every client it can -- people still picking a room,
+rooms waiting for someone to join and, when both processes run the thread
+engine with pairs, live chats mid-conversation -- and lets everyone else
+finish until --drain-timeout.
+
+Messages are workers.send_json() packets with the client sockets attached.
+"""
+
+import os
+import socket
+import threading
+
+from workers import recv_json, send_json
+
+
+class Successor:
+    """Old process's channel to the server that took over. Thread-safe."""
+
+    def __init__(self, sock, pid, live):
+        self.sock = sock
+        self.pid  = pid
+        self.live = live    # it can resume pairs mid-conversation
+        self.lock = threading.Lock()
+
+    def send(self, msg, socks):
+        """Pass msg and socks over; False if the new process is gone."""
+        try:
+            with self.lock:
+                send_json(self.sock, msg, [s.fileno() for s in socks])
+            return True
+        except OSError:
+            return False
+
+    def close(self):
+        """Tell the new process nothing more is coming."""
+        with self.lock:
+            try:
+                send_json(self.sock, {"op": "done"})
+            except OSError:
+                pass
+            self.sock.close()
+
+
+def takeover(path, live):
+    """
+    Take the listening socket over from the server offering it on path.
+    live says whether this process can resume pairs mid-conversation.
+    Returns (listener, old pid, channel for adopt()), or None if no server
+    is running there.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        sock.connect(path)
+        send_json(sock, {"op": "takeover", "pid": os.getpid(), "live": live})
+        reply, fds = recv_json(sock)
+    except OSError:
+        sock.close()
+        return None
+    if reply is None or not fds:
+        sock.close()
+        return None  # it is shutting down already
+    return socket.socket(fileno=fds[0]), reply["pid"], sock
+
+
+def adopt(sock, on_client, on_pair=None):
+    """
+    Receive what the old process passes over on sock, from a helper thread:
+    on_client(conn, name, room_id, info) for a client that isn't chatting
+    yet, on_pair(room_id, conns, sides) for a pair mid-conversation.
+    """
+    def run():
+        while True:
+            try:
+                msg, fds = recv_json(sock, 2)
+            except OSError:
+                msg, fds = None, []
+            if msg is None or msg["op"] == "done":
+                sock.close()
+                return
+            conns = [socket.socket(fileno=fd) for fd in fds]
+            if msg["op"] == "client":
+                on_client(conns[0], msg["name"], msg["room"], msg["info"])
+            elif msg["op"] == "pair" and on_pair is not None:
+                on_pair(msg["room"], conns, msg["sides"])
+            else:
+                for conn in conns:
+                    conn.close()
+
+    threading.Thread(target=run, name="handoff", daemon=True).start()
+
+
+def offer(path, listener, on_takeover):
+    """
+    Offer listener to the next server process started with this path, and
+    call on_takeover(successor) from a helper thread once one has taken it.
+    Returns a function that withdraws the offer and removes path, unless a
+    newer server owns path by then.
+    """
+    ctl = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    # Bind under a private name and rename it into place, so path never
+    # goes missing while one server hands over to the next.
+    tmp = f"{path}.{os.getpid()}"
+    try:
+        os.unlink(tmp)
+    except FileNotFoundError:
+        pass
+    ctl.bind(tmp)
+    ctl.listen(1)
+    os.replace(tmp, path)
+    inode = os.stat(path).st_ino
+
+    def run():
+        while True:
+            try:
+                sock, _ = ctl.accept()
+            except OSError:
+                return  # withdrawn
+            try:
+                msg, fds = recv_json(sock)
+                for fd in fds:
+                    os.close(fd)
+                if msg is not None and msg.get("op") == "takeover":
+                    send_json(sock, {"pid": os.getpid()}, [listener.fileno()])
+                    break
+            except (OSError, ValueError):
+                pass
+            sock.close()
+        ctl.close()
+        on_takeover(Successor(sock, msg["pid"], msg.get("live", False)))
+
+    def withdraw():
+        try:
+            ctl.shutdown(socket.SHUT_RDWR)  # wakes the accept() above
+        except OSError:
+            pass
+        try:
+            if os.stat(path).st_ino == inode:
+                os.unlink(path)
+        except OSError:
+            pass
+
+    threading.Thread(target=run, name="handoff", daemon=True).start()
+    return withdraw
@@ -0,0 +1,129 @@
+"""
+Admission control and rate limits for server.py.
+
+Admission runs in the accept path, before a thread or task is spent on a
+connection: past any of its limits the client gets a one-line SYS:Server
+busy reply and is closed straight away. RateLimit budgets what one
+connection may send once it is chatting.
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    rate tokens a second, saving up to burst. Not locked; each bucket
+    belongs to one thread (or the event loop).
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate   = rate
+        self.burst  = burst or rate
+        self.tokens = self.burst
+        self.stamp  = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, n=1):
+        """Take n tokens if there are that many; False otherwise."""
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def wait(self, n=1):
+        """
+        Seconds until there are n tokens, or a full bucket if n is more
+        than burst; 0.0 if that is now.
+        """
+        self._refill()
+        return max(0.0, (min(n, self.burst) - self.tokens) / self.rate)
+
+
+class Admission:
+    """
+    Limits on connections this process is serving. 0 turns a limit off.
+
+        max_conns       connections open at once
+        max_per_ip      connections open at once from one address
+        max_handshakes  connections still answering PROMPT:name/room
+        accept_rate     new connections a second (bursts up to that many)
+    """
+
+    def __init__(self, max_conns=0, max_per_ip=0, max_handshakes=0, accept_rate=0):
+        self.max_conns      = max_conns
+        self.max_per_ip     = max_per_ip
+        self.max_handshakes = max_handshakes
+        self.bucket         = TokenBucket(accept_rate) if accept_rate else None
+        self.open           = 0
+        self.per_ip         = {}
+        self.handshakes     = 0
+        self.lock           = threading.Lock()
+
+    def admit(self, ip):
+        """
+        None if a new connection from ip may in, and count it as open and
+        handshaking; else why not.
+        """
+        with self.lock:
+            if self.max_conns and self.open >= self.max_conns:
+                return "connection limit"
+            if self.max_per_ip and self.per_ip.get(ip, 0) >= self.max_per_ip:
+                return "per-address limit"
+            if self.max_handshakes and self.handshakes >= self.max_handshakes:
+                return "handshake limit"
+            if self.bucket is not None and not self.bucket.take():
+                return "accept rate"
+            self.open += 1
+            self.per_ip[ip] = self.per_ip.get(ip, 0) + 1
+            self.handshakes += 1
+        return None
+
+    def handshake_done(self):
+        with self.lock:
+            self.handshakes -= 1
+
+    def leave(self, ip):
+        with self.lock:
+            self.open -= 1
+            n = self.per_ip[ip] - 1
+            if n:
+                self.per_ip[ip] = n
+            else:
+                del self.per_ip[ip]
+
+
+class RateLimit:
+    """
+    What one connection may send: msg_rate lines and byte_rate bytes a
+    second, each saving up to its burst (one second's worth by default).
+    0 turns a budget off.
+    """
+
+    def __init__(self, msg_rate=0, msg_burst=0, byte_rate=0, byte_burst=0):
+        self.msgs  = TokenBucket(msg_rate, msg_burst) if msg_rate else None
+        self.bytes = TokenBucket(byte_rate, byte_burst) if byte_rate else None
+
+    def take(self, nbytes):
+        """
+        Account for one line (or frame) of nbytes if both budgets allow it
+        now and return 0.0; else how long until they will. A line longer
+        than the byte burst goes once that bucket is full, into debt.
+        """
+        pause = 0.0
+        if self.msgs is not None:
+            pause = self.msgs.wait(1)
+        if self.bytes is not None:
+            pause = max(pause, self.bytes.wait(nbytes))
+        if pause:
+            return pause
+        if self.msgs is not None:
+            self.msgs.tokens -= 1
+        if self.bytes is not None:
+            self.bytes.tokens -= nbytes
+        return 0.0
@@ -0,0 +1,296 @@
+"""
+Load generator for NormansChat: simulated pairs that speak the real
+protocol against a running server.py and report how it holds up.
+
+Every pair connects two clients that answer PROMPT:name / PROMPT:room, meet
+in a room of their own and wait for CONNECTED:. One side then sends a
+message, the other echoes it back, --messages times after one unmeasured
+warm-up round; the first side says /quit and the other waits for the
+goodbye. Reported:
+
+    setup       connections (through the name/room prompts) per second
+    pairing     joiner sends its room code -> CONNECTED: arrives
+    round trip  message out -> echo back, p50/p99/p999
+    throughput  MSG lines delivered per second during the exchange phase
+
+    python loadgen.py --pairs 1000 --messages 100
+    python loadgen.py --spawn --server-args "--engine asyncio" --max-p99 5
+
+--spawn starts server.py on --port itself and stops it afterwards. The exit
+status is non-zero if any pair failed or --max-p99 was exceeded, so this can
+gate a release.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class PairFailed(Exception):
+    pass
+
+
+class Stats:
+    def __init__(self):
+        self.setup   = []    # (start, end) per connection, through PROMPT:room
+        self.pairing = []    # seconds
+        self.rtt     = []    # seconds
+        self.failed  = []    # error strings
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float("nan")
+    i = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))
+    return sorted_values[i]
+
+
+async def read_until(reader, prefix, timeout):
+    """Read lines until one starts with prefix; return it without the newline."""
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if not line:
+            raise PairFailed(f"EOF while waiting for {prefix.decode()!r}")
+        if line.startswith(prefix):
+            return line.rstrip(b"\r\n")
+
+
+async def connect(args, name, stats):
+    """Open a client and get it through the handshake up to its room code."""
+    start = time.perf_counter()
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(args.host, args.port, limit=args.size + 1024),
+        args.timeout)
+    await read_until(reader, b"PROMPT:name", args.timeout)
+    writer.write(f"{name}\n".encode())
+    await read_until(reader, b"PROMPT:room", args.timeout)
+    stats.setup.append((start, time.perf_counter()))
+    return reader, writer
+
+
+async def run_pair(i, args, stats, ready, go):
+    """One simulated pair; calls ready() once set up (or failed), then waits for go."""
+    room = f"LG{os.getpid()}X{i}"
+    writers = []
+    try:
+        a_reader, a_writer = await connect(args, f"a{i}", stats)
+        writers.append(a_writer)
+        a_writer.write(f"{room}\n".encode())
+        await read_until(a_reader, b"SYS:Room closes", args.timeout)
+
+        b_reader, b_writer = await connect(args, f"b{i}", stats)
+        writers.append(b_writer)
+        t = time.perf_counter()
+        b_writer.write(f"{room}\n".encode())
+        await read_until(b_reader, b"CONNECTED:", args.timeout)
+        stats.pairing.append(time.perf_counter() - t)
+        await read_until(a_reader, b"CONNECTED:", args.timeout)
+    except (OSError, asyncio.TimeoutError, PairFailed) as e:
+        stats.failed.append(f"pair {i} setup: {e!r}")
+        for writer in writers:
+            writer.close()
+        return
+    finally:
+        ready()
+    await go.wait()
+
+    payload = "x" * args.size
+    from_a  = f"MSG:a{i}:".encode()
+    from_b  = f"MSG:b{i}:".encode()
+    try:
+        for seq in range(-1, args.messages):  # round -1 warms the pair up, unmeasured
+            t = time.perf_counter()
+            a_writer.write(f"{seq} {payload}\n".encode())
+            line = await read_until(b_reader, from_a, args.timeout)
+            b_writer.write(line[len(from_a):] + b"\n")
+            line = await read_until(a_reader, from_b, args.timeout)
+            if seq >= 0:
+                stats.rtt.append(time.perf_counter() - t)
+            if int(line[len(from_b):].split(b" ", 1)[0]) != seq:
+                raise PairFailed(f"echo out of order at {seq}")
+
+        a_writer.write(b"/quit\n")
+        await read_until(b_reader, b"SYS:Partner has left", args.timeout)
+    except (OSError, asyncio.TimeoutError, PairFailed, ValueError) as e:
+        stats.failed.append(f"pair {i} exchange: {e!r}")
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+async def run_load(args):
+    stats = Stats()
+    go = asyncio.Event()
+
+    # At most --concurrency pairs connect at once so a big run doesn't
+    # overflow the listen backlog; everyone starts the exchange together.
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def start(i):
+        async with sem:
+            ready = asyncio.Event()
+            task = asyncio.ensure_future(run_pair(i, args, stats, ready.set, go))
+            await ready.wait()
+        return task
+
+    t0 = time.perf_counter()
+    tasks = await asyncio.gather(*(start(i) for i in range(args.pairs)))
+    t1 = time.perf_counter()
+    go.set()
+    await asyncio.gather(*tasks)
+    t2 = time.perf_counter()
+    return stats, t1 - t0, t2 - t1
+
+
+def report(args, stats, setup_secs, exchange_secs):
+    pairing = sorted(stats.pairing)
+    rtt = sorted(stats.rtt)
+    ms = lambda v: round(v * 1000, 3)
+    result = {
+        "pairs":          args.pairs,
+        "failed":         len(stats.failed),
+        "connections":    len(stats.setup),
+        "setup_per_sec":  round(len(stats.setup) / setup_secs, 1) if setup_secs else 0,
+        "pairing_ms":     {f"p{p}": ms(percentile(pairing, p)) for p in (50, 99, 99.9)},
+        "rtt_ms":         {f"p{p}": ms(percentile(rtt, p)) for p in (50, 99, 99.9)},
+        "msgs_per_sec":   round(2 * len(rtt) / exchange_secs, 1) if exchange_secs else 0,
+    }
+    if args.json:
+        print(json.dumps(result))
+        return result
+
+    fmt = lambda d: "  ".join(f"{k} {v:.3f} ms" for k, v in d.items())
+    print(f"[*] {args.pairs} pairs, {args.messages} round trips each, "
+          f"{args.size}-byte messages")
+    print(f"[+] setup       {result['connections']} connections in {setup_secs:.2f}s "
+          f"({result['setup_per_sec']:.0f}/s)")
+    print(f"[+] pairing     {fmt(result['pairing_ms'])}")
+    print(f"[+] round trip  {fmt(result['rtt_ms'])}")
+    print(f"[+] throughput  {result['msgs_per_sec']:.0f} msg/s over {exchange_secs:.2f}s")
+    for err in stats.failed[:10]:
+        print(f"[-] {err}")
+    if len(stats.failed) > 10:
+        print(f"[-] ... {len(stats.failed) - 10} more failures")
+    return result
+
+
+def raise_fd_limit():
+    """Each simulated pair holds two sockets."""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+
+def spawn_server(args):
+    cmd = [sys.executable, os.path.join(HERE, "server.py")] + shlex.split(args.server_args)
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.1)
+    proc.kill()
+    sys.exit(f"[ERROR] server.py {args.server_args} did not start listening")
+
+
+def stop_server(proc):
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def client(args, name, room, opts=(), timeout=30):
+    """Blocking client for the bench_*.py scripts, through the prompts: (conn, reader)."""
+    conn = socket.create_connection((args.host, args.port), timeout=timeout)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = conn.makefile("rb")
+    for opt in opts:
+        conn.sendall(f"OPT:{opt}\n".encode())
+        if not until(reader, f"OPT:{opt}:".encode()).startswith(f"OPT:{opt}:on".encode()):
+            raise OSError(f"server refused OPT:{opt}")
+    for prompt, answer in ((b"PROMPT:name", name), (b"PROMPT:room", room)):
+        while not reader.readline().startswith(prompt):
+            pass
+        conn.sendall(answer.encode() + b"\n")
+    return conn, reader
+
+
+def until(reader, prefix):
+    """The next line from reader that starts with prefix; EOFError if none comes."""
+    while True:
+        line = reader.readline()
+        if not line:
+            raise EOFError(prefix)
+        if line.startswith(prefix):
+            return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NormansChat load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--pairs", type=int, default=100, metavar="N",
+                        help="simulated pairs, two connections each (default 100)")
+    parser.add_argument("--messages", type=int, default=100, metavar="N",
+                        help="round trips per pair (default 100)")
+    parser.add_argument("--size", type=int, default=32, metavar="BYTES",
+                        help="message payload size (default 32)")
+    parser.add_argument("--concurrency", type=int, default=200, metavar="N",
+                        help="pairs connecting at the same time (default 200)")
+    parser.add_argument("--timeout", type=float, default=30, metavar="SECS",
+                        help="longest wait for any single reply (default 30)")
+    parser.add_argument("--max-p99", type=float, metavar="MS",
+                        help="fail if round-trip p99 is above this")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as one JSON object")
+    parser.add_argument("--spawn", action="store_true",
+                        help="start server.py for the run and stop it afterwards")
+    parser.add_argument("--server-args", default="", metavar="ARGS",
+                        help="extra arguments for server.py with --spawn")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    proc = spawn_server(args) if args.spawn else None
+    try:
+        stats, setup_secs, exchange_secs = asyncio.run(run_load(args))
+    finally:
+        if proc is not None:
+            stop_server(proc)
+    result = report(args, stats, setup_secs, exchange_secs)
+
+    if stats.failed:
+        sys.exit(1)
+    if args.max_p99 is not None and result["rtt_ms"]["p99"] > args.max_p99:
+        if not args.json:
+            print(f"[!] round-trip p99 {result['rtt_ms']['p99']:.3f} ms is over "
+                  f"the {args.max_p99} ms budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
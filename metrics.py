@@ -0,0 +1,280 @@
+"""
+Live counters, gauges and latency histograms for server.py in the
+Prometheus text format.
+
+Metrics register themselves at creation and are always updated; serve()
+just makes them scrapeable over HTTP at /metrics. Updates take a small lock
+so any server thread may touch them.
+
+Histograms keep full resolution in-process and can be dumped to JSON with
+dump(); dumps from several worker processes merge back into one:
+
+    python metrics.py histograms-*.json
+"""
+
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+
+registry = []
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name  = name
+        self.help  = help
+        self.value = 0
+        self.lock  = threading.Lock()
+        registry.append(self)
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, n=1):
+        with self.lock:
+            self.value -= n
+
+
+class GaugeFunc:
+    """A gauge read from fn() at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn   = fn
+        registry.append(self)
+
+    def samples(self):
+        return [(self.name, self.fn())]
+
+
+class Summary:
+    """Count and total of observed values, e.g. seconds spent."""
+    kind = "summary"
+
+    def __init__(self, name, help):
+        self.name  = name
+        self.help  = help
+        self.count = 0
+        self.sum   = 0.0
+        self.lock  = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value):
+        with self.lock:
+            self.count += 1
+            self.sum   += value
+
+    def samples(self):
+        return [(self.name + "_sum", self.sum), (self.name + "_count", self.count)]
+
+
+class Histogram:
+    """
+    High-dynamic-range latency histogram, HdrHistogram style.
+
+    Values are recorded in whole microseconds into log-linear buckets: 128
+    linear steps per power of two, so any value up to hours is kept within
+    1% and recording is a couple of integer ops. Scrapes see it as a
+    Prometheus histogram over BOUNDS; dump() and merge() keep every bucket.
+    """
+    kind = "histogram"
+
+    SUB_BITS = 7
+    BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+              0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 600)
+
+    def __init__(self, name, help):
+        self.name   = name
+        self.help   = help
+        self.counts = []
+        self.count  = 0
+        self.sum    = 0      # microseconds
+        self.lock   = threading.Lock()
+        registry.append(self)
+
+    @classmethod
+    def _index(cls, us):
+        shift = max(0, us.bit_length() - cls.SUB_BITS - 1)
+        return (shift << cls.SUB_BITS) + (us >> shift)
+
+    @classmethod
+    def _value(cls, index):
+        """Lowest value (in us) that lands in bucket index."""
+        shift = max(0, (index >> cls.SUB_BITS) - 1)
+        return (index - (shift << cls.SUB_BITS)) << shift
+
+    def observe(self, seconds):
+        us = max(0, int(seconds * 1e6))
+        shift = us.bit_length() - 8     # _index(), inlined for the hot path
+        i = us if shift <= 0 else (shift << 7) + (us >> shift)
+        with self.lock:
+            counts = self.counts
+            if i >= len(counts):
+                counts.extend([0] * (i + 1 - len(counts)))
+            counts[i] += 1
+            self.count += 1
+            self.sum += us
+
+    def percentile(self, p):
+        """Value in seconds at or below which p percent of samples fall."""
+        with self.lock:
+            counts = list(self.counts)
+            total = self.count
+        if not total:
+            return 0.0
+        rank = max(1, -(-total * p // 100))
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= rank:
+                return (self._value(i + 1) - 1) / 1e6  # top of the bucket
+        return 0.0
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total, total_us = self.count, self.sum
+        out = []
+        seen = 0
+        i = 0
+        for bound in self.BOUNDS:
+            limit = bound * 1e6
+            while i < len(counts) and self._value(i) <= limit:
+                seen += counts[i]
+                i += 1
+            out.append((f'{self.name}_bucket{{le="{bound}"}}', seen))
+        out.append((f'{self.name}_bucket{{le="+Inf"}}', total))
+        out.append((f"{self.name}_sum", total_us / 1e6))
+        out.append((f"{self.name}_count", total))
+        return out
+
+    def to_dict(self):
+        with self.lock:
+            return {"count": self.count, "sum_us": self.sum,
+                    "counts": {i: n for i, n in enumerate(self.counts) if n}}
+
+    def merge(self, data):
+        """Add in a to_dict() from another process."""
+        with self.lock:
+            for i, n in data["counts"].items():
+                i = int(i)
+                if i >= len(self.counts):
+                    self.counts.extend([0] * (i + 1 - len(self.counts)))
+                self.counts[i] += n
+            self.count += data["count"]
+            self.sum += data["sum_us"]
+
+    def summary(self):
+        ms = lambda p: f"{self.percentile(p) * 1000:.3f}"
+        return (f"{self.name}  n={self.count}  p50 {ms(50)}  p99 {ms(99)}  "
+                f"p99.9 {ms(99.9)}  max {ms(100)} ms")
+
+
+def histograms():
+    return [m for m in registry if isinstance(m, Histogram)]
+
+
+def dump(directory="."):
+    """Write every histogram to histograms-<pid>.json; returns the path."""
+    path = os.path.join(directory, f"histograms-{os.getpid()}.json")
+    data = {"pid": os.getpid(), "time": time.time(),
+            "histograms": {h.name: h.to_dict() for h in histograms()}}
+    with open(path, "w") as f:
+        json.dump(data, f)
+    return path
+
+
+class TimedLock:
+    """threading.Lock that reports how long it was held to a Summary."""
+
+    def __init__(self, summary):
+        self._lock    = threading.Lock()
+        self._summary = summary
+        self._since   = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(blocking, timeout):
+            self._since = time.perf_counter()
+            return True
+        return False
+
+    def release(self):
+        held = time.perf_counter() - self._since
+        self._lock.release()
+        self._summary.observe(held)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, value in metric.samples():
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # scrapes would drown the chat log
+
+
+def serve(port, host="0.0.0.0"):
+    """Serve /metrics on port from a daemon thread."""
+    httpd = http.server.ThreadingHTTPServer((host, port), _Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+    return httpd
+
+
+def main(paths):
+    """Merge histogram dumps (e.g. one per worker) and print percentiles."""
+    merged = {}
+    for path in paths:
+        with open(path) as f:
+            for name, data in json.load(f)["histograms"].items():
+                if name not in merged:
+                    merged[name] = Histogram(name, "")
+                merged[name].merge(data)
+    print(f"[*] {len(paths)} dump(s)")
+    for hist in merged.values():
+        print(f"[+] {hist.summary()}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("usage: python metrics.py histograms-<pid>.json ...")
+    main(sys.argv[1:])
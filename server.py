@@ -1,11 +1,210 @@
+import argparse
+import asyncio
+import collections
+import contextlib
+import itertools
+import os
+import select
+import selectors
+import signal
 import socket
+import tempfile
 import threading
 import time
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+import eventlog
+import handoff
+import metrics
+import sockopts
+import workers
+from limits import Admission, RateLimit
+from timers import TimerHeap
+from framing import (MAX_LINE, FRAME_MSG, FRAME_QUIT, FRAME_ZMSG, BadFrame, FrameDecoder,
+                     LineFramer, deflate, inflate, line_frames, msg_prefix, split_msg,
+                     varint)
+
 TIMEOUT_SECONDS = 600  # 10 minutes before closing an empty room
+ROOM_SIZE       = 2    # members per room; above 2 rooms are group chats
+DRAIN_SECONDS   = 30   # on shutdown, how long chats get to finish
+
+# Group rooms replay their last messages to whoever joins (see History):
+# at most HISTORY_LINES of them and HISTORY_BYTES per room, HISTORY_TOTAL
+# bytes over all rooms. 0 lines turns history off.
+HISTORY_LINES = 50
+HISTORY_BYTES = 16 * 1024
+HISTORY_TOTAL = 64 * 1024 * 1024
+
+# Per-connection options a client can ask for by answering PROMPT:name with
+# "OPT:<option>" lines before its name.
+#   raw     once paired, relay bytes untouched via splice() (thread engine,
+#           Linux only); see relay_splice() for the framing the peer receives.
+#   binary  after the first CONNECTED: line, talk length-prefixed frames
+#           instead of lines (see framing.py), so messages may hold any bytes
+#           and are relayed without being scanned.
+#   deflate binary, plus compressed ZMSG frames both ways. Compressed
+#           messages pass between deflate peers untouched; the server only
+#           inflates or deflates for peers that differ.
+#   batch   for bots streaming many lines: read up to BATCH_READ bytes at
+#           a time and, after a read that brought data, let BATCH_DELAY
+#           pass before the next, so every recv() and every peer's write
+#           carries as many lines as possible, in one buffer.
+THREAD_OPTIONS = {"batch", "binary", "deflate"} | ({"raw"} if hasattr(os, "splice") else set())
+ASYNC_OPTIONS  = {"batch", "binary", "deflate"}
+
+BATCH_READ  = 65536
+BATCH_DELAY = 0.0005  # seconds
+
+# Messages the server compresses for deflate peers: none shorter than
+# COMPRESS_MIN bytes (they'd barely shrink), at zlib level COMPRESS_LEVEL.
+COMPRESS_MIN   = 256
+COMPRESS_LEVEL = 6
+
+SPLICE_CHUNK = 65536  # default pipe capacity
+IOV_MAX      = 1024   # most buffers one sendmsg() takes on Linux and BSDs
+
+# Relays watch two or three fds each; poll() needs no fd of its own, where
+# epoll would cost one more per chatting connection.
+Selector = getattr(selectors, "PollSelector", selectors.DefaultSelector)
+
+HANDSHAKE_MAX_LINE = 1024     # names and room codes
+MAX_LINE_BYTES     = MAX_LINE  # chat lines; a longer line ends the chat
+
+# Bytes waiting to go out to one connection. Past QUEUE_HIGH the overflow
+# policy decides what happens to more messages for it:
+#   block       stop reading from whoever sends to it until the queue is
+#               back under QUEUE_LOW (nothing is lost)
+#   drop        discard messages for it until it is back under QUEUE_LOW
+#   disconnect  drop the slow connection
+# A message for an empty queue is always taken, however long it is.
+QUEUE_HIGH        = 256 * 1024
+QUEUE_LOW         = 64 * 1024
+OVERFLOW_POLICIES = ("block", "drop", "disconnect")
+OVERFLOW_POLICY   = "block"
+
+# Admission control (limits.Admission), per process; 0 means no limit.
+# Connections past a limit get BUSY and are closed without a thread.
+MAX_CONNECTIONS = 10000
+MAX_PER_IP      = 0
+MAX_HANDSHAKES  = 1000
+ACCEPT_RATE     = 0    # new connections a second
+BUSY            = b"SYS:Server busy, try again later.\n"
+
+# What one chatting connection may send (limits.RateLimit); 0 means no
+# limit, a burst of 0 one second's worth. Budgets are taken line by line:
+# past the burst, the rest of what one recv() brought waits in the framer
+# and the sender's reads pause, so any more waits in its own socket buffers
+# (and TCP pushes back on it) rather than in ours.
+MSG_RATE   = 0     # lines a second
+MSG_BURST  = 0
+BYTE_RATE  = 0     # bytes a second
+BYTE_BURST = 0
+SLOW_DOWN  = b"SYS:Slow down! You are over the rate limit; your messages are delayed.\n"
+
+# How long a connection may take, kept by the central timer (deadlines, or
+# the event loop) instead of socket timeouts, so a dead or half-open peer
+# can't pin a thread or task for long. 0 turns a limit off.
+HANDSHAKE_SECONDS  = 60    # connect to room code
+HANDSHAKE_MIN_RATE = 0     # bytes a second a handshake must average (slowloris)
+HANDSHAKE_CHECK    = 5     # how often that average is looked at
+IDLE_SECONDS       = 0     # a chat with no messages either way
+SESSION_SECONDS    = 0     # chatting, however actively
+TOO_SLOW           = b"SYS:Too slow picking a name and room. Goodbye!\n"
+SESSION_OVER       = b"SYS:Chat time limit reached. Goodbye!\n"
+
+# TCP options for the listener and every connection (see sockopts.py).
+SOCKET_OPTIONS = sockopts.PROFILES["chat"]
+
+# Each connection is a thread on the thread engine; the default 8 MiB stack
+# reservation per thread is what runs a connect storm out of memory.
+THREAD_STACK = 512 * 1024
+
+# Waiting rooms, striped over ROOM_SHARDS (dict, lock) pairs by room code so
+# creates and joins of different rooms don't queue on one lock.
+ROOM_SHARDS = 64
+
+# ── metrics (scrape with --metrics-port) ──
+STATS_DIR = tempfile.gettempdir()  # SIGUSR1 writes histograms-<pid>.json here
+
+CONNECTIONS_OPEN   = metrics.Gauge("chat_connections_open", "Client connections open now")
+CONNECTIONS        = metrics.Counter("chat_connections_total", "Client connections accepted")
+CONNECTIONS_REJECTED = metrics.Counter("chat_connections_rejected_total",
+                                       "Connections turned away by admission control")
+HANDSHAKE_FAILURES = metrics.Counter("chat_handshake_failures_total",
+                                     "Clients that left or broke off before picking a room")
+ROOMS_WAITING      = metrics.Gauge("chat_rooms_waiting", "Rooms waiting for someone to join")
+ROOMS_ACTIVE       = metrics.Gauge("chat_rooms_active", "Rooms with a conversation going")
+ROOMS_EXPIRED      = metrics.Counter("chat_rooms_expired_total",
+                                     "Rooms closed because nobody joined in time")
+MESSAGES_RELAYED   = metrics.Counter("chat_messages_relayed_total",
+                                     "Chat lines relayed (once per line, not per recipient)")
+TRANSCODED         = metrics.Counter("chat_messages_transcoded_total",
+                                     "Messages the server had to deflate or inflate for OPT:deflate")
+HISTORY_SIZE       = metrics.Gauge("chat_history_bytes",
+                                   "Bytes of room history kept, over all rooms")
+BYTES_RELAYED      = metrics.Counter("chat_bytes_relayed_total",
+                                     "Bytes pushed to recipients, raw relays included")
+ROOM_LOCK_HELD     = metrics.Summary("chat_room_lock_hold_seconds",
+                                     "Time the room directory shard locks were held")
+metrics.GaugeFunc("chat_threads", "Threads alive in this process", threading.active_count)
+HANDSHAKE_PROMPT   = metrics.Histogram("chat_handshake_prompt_seconds",
+                                       "Accept to PROMPT:name sent")
+PAIRING            = metrics.Histogram("chat_pairing_seconds",
+                                       "Room code received to CONNECTED: sent")
+ROOM_WAIT          = metrics.Histogram("chat_room_wait_seconds",
+                                       "Time room creators waited for someone to join")
+TIMEOUTS           = metrics.Counter("chat_timeouts_total",
+                                     "Connections cut off by the handshake, idle or session timeout")
+THROTTLED          = metrics.Counter("chat_throttled_total",
+                                     "Times a sender went over its rate limit")
+THROTTLE_PAUSE     = metrics.Summary("chat_throttle_pause_seconds",
+                                     "Time rate-limited senders had their reads paused")
+RELAY_HOP          = metrics.Histogram("chat_relay_hop_seconds",
+                                       "recv() of chat data to its send to every recipient")
+
+room_shards = [({}, metrics.TimedLock(ROOM_LOCK_HELD)) for _ in range(ROOM_SHARDS)]
+
+
+def room_shard(room_id):
+    """The (rooms, lock) shard of the room directory holding room_id."""
+    return room_shards[hash(room_id) % ROOM_SHARDS]
+
+
+if hasattr(socket.socket, "sendmsg"):
+    def sendv(conn, bufs):
+        """Send a list of buffers with one gather-write syscall."""
+        return conn.sendmsg(bufs)
+else:  # Windows
+    def sendv(conn, bufs):
+        return conn.send(b"".join(bufs))
+
+
+# Set in --workers mode: the parent's room directory (workers.BrokerClient).
+broker = None
+
+# Thread engine: the one timer thread (timers.TimerHeap) behind room expiry
+# and the handshake, idle and session timeouts.
+deadlines = None
+
+# Set up by main() from the --max-* options.
+admission = Admission()
+
+# ── graceful shutdown (see drain()) ──
+draining    = False  # the listener is closed; no new chats start
+moving      = False  # draining into a successor that resumes live pairs
+successor   = None   # handoff.Successor once a new server process took over
+predecessor = None   # channel from the process we took over (handoff.adopt)
+
+# Members relaying right now -> their pair's StopEvent (None for groups and
+# on the asyncio engine), so drain() can reach every chat.
+chatting      = {}
+chatting_lock = threading.Lock()
 
-rooms = {}
-rooms_lock = threading.Lock()
+SHUTDOWN_GOODBYE = "SYS:Server is shutting down. Goodbye!"
 
 BANNER = """
 ╔══════════════════════════════════════╗
@@ -15,212 +214,2141 @@ BANNER = """
 """
 
 
-def read_line(conn):
-    """Read a full line from client. Returns string or None on error."""
-    buf = b""
+def read_line(conn, framer):
+    """
+    Read a full line from client. Returns string or None on error.
+    framer is the connection's read buffer: anything that arrived after the
+    line stays in it for the next read_line() or for relay().
+    """
     try:
-        conn.settimeout(TIMEOUT_SECONDS + 60)
         while True:
+            line = framer.next_line()
+            if line is not None:
+                return line.decode(errors="ignore").strip()
             chunk = conn.recv(1024)
             if not chunk:
                 return None
-            buf += chunk
-            for sep in (b"\r\n", b"\n", b"\r"):
-                if sep in buf:
-                    line, _ = buf.split(sep, 1)
-                    return line.decode(errors="ignore").strip()
+            framer.push(chunk)
     except:
         return None
 
 
-def relay(sender, receiver, sender_name, stop_event):
+class StopEvent:
     """
-    Read messages from sender, forward to receiver.
-    Format sent to receiver:  MSG:<name>:<message>
-    Nothing is sent back to sender (no echo).
+    threading.Event that also rings the wakers watching it, so a relay
+    blocked in select() wakes up the moment its partner leaves instead of
+    polling. Shared by the two sides of a room; holds no fds of its own.
     """
-    buf = b""
-    try:
-        while not stop_event.is_set():
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._wakers = []
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+    def watch(self, waker):
+        """Ring waker on set(), or now if that already happened."""
+        with self._lock:
+            self._wakers.append(waker)
+            if not self._event.is_set():
+                return
+        waker.wake()
+
+    def set(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            wakers = list(self._wakers)
+        for waker in wakers:
+            waker.wake()
+
+
+class Waker:
+    """
+    Doorbell: wake() from any thread, select() on fileno(). One eventfd
+    where the platform has it, else one end of a socketpair.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()  # no wake() into a closed, reused fd
+        if hasattr(os, "eventfd"):
+            self._r = self._w = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            r, w = socket.socketpair()
+            r.setblocking(False)
+            w.setblocking(False)
+            self._r, self._w = r.detach(), w.detach()
+
+    def fileno(self):
+        return self._r
+
+    def wake(self):
+        with self._lock:
+            if self._w < 0:
+                return
             try:
-                sender.settimeout(1.0)
-                chunk = sender.recv(1024)
-            except socket.timeout:
-                continue
-            except:
-                break
+                if self._w == self._r:
+                    os.eventfd_write(self._w, 1)
+                else:
+                    os.write(self._w, b"x")
+            except OSError:
+                pass  # already full of wake-ups
 
-            if not chunk:
-                break
+    def drain(self):
+        try:
+            if self._w == self._r:
+                os.eventfd_read(self._r)
+            else:
+                while os.read(self._r, 4096):
+                    pass
+        except OSError:
+            pass
+
+    def close(self):
+        with self._lock:
+            fds = {self._r, self._w} - {-1}
+            self._r = self._w = -1
+        for fd in fds:
+            os.close(fd)
 
-            buf += chunk
 
-            while b"\n" in buf:
-                line, buf = buf.split(b"\n", 1)
-                msg = line.replace(b"\r", b"").decode(errors="ignore").strip()
-                if not msg:
+class Member:
+    """
+    A chat connection (thread engine) with a bounded outbox.
+
+    Any thread may push() bytes to it. What the socket won't take right
+    away is queued, and the member's own thread flushes the queue once the
+    socket is writable again, so a slow reader never blocks its peers; see
+    QUEUE_HIGH for what happens when it falls too far behind.
+    """
+
+    def __init__(self, conn, name, opts=()):
+        self.conn     = conn
+        self.name     = name
+        self.binary   = "binary" in opts    # gets frames, sends frames
+        self.deflate  = "deflate" in opts   # ... some of them ZMSG
+        self.prefix   = msg_prefix(name)
+        self.zprefix  = msg_prefix(name, FRAME_ZMSG)
+        self.line_prefix = f"MSG:{name}:".encode()
+        self.batch    = "batch" in opts     # reads and relays in batches
+        self.raw      = False  # relay_splice() owns the socket; see say()
+        self.queue    = collections.deque()
+        self.size     = 0      # bytes in queue
+        self.paused   = []     # members not reading until we drain (block)
+        self.dropping = False  # over QUEUE_HIGH under drop/disconnect
+        self.closed   = False
+        self.lock     = threading.Lock()
+        self.waker    = Waker()
+        self.since    = 0.0    # monotonic: relay() started / last message
+        self.active   = 0.0
+        self.timer    = None   # watch_chat()
+        self.ended    = None   # the line hang_up() ended the chat with
+        conn.setblocking(False)
+
+    def push(self, *bufs):
+        """
+        Send or queue bufs, in order, with one sendmsg() when the queue is
+        empty. False if they were refused or the socket is gone.
+        """
+        size = sum(map(len, bufs))
+        with self.lock:
+            if self.dropping:
+                return False  # until flush() gets it under QUEUE_LOW
+            if self.queue:
+                if self.size + size > QUEUE_HIGH and OVERFLOW_POLICY != "block":
+                    return self._overflow()
+                self.queue.extend(bufs)
+                self.size += size
+                return True
+            try:
+                n = sendv(self.conn, bufs)
+            except BlockingIOError:
+                n = 0
+            except OSError:
+                return False  # gone; its own thread will notice
+            if n < size:
+                for buf in bufs:
+                    if n >= len(buf):
+                        n -= len(buf)
+                        continue
+                    rest = memoryview(buf)[n:] if n else buf
+                    n = 0
+                    self.queue.append(rest)
+                    self.size += len(rest)
+                self.waker.wake()
+            return True
+
+    def _overflow(self):
+        if not self.dropping:
+            self.dropping = True
+            if OVERFLOW_POLICY == "disconnect":
+                eventlog.warning("overflow", f"[!] {self.name} can't keep up; disconnecting.",
+                                 name=self.name, policy=OVERFLOW_POLICY)
+            else:
+                eventlog.warning("overflow", f"[!] {self.name} can't keep up; dropping messages.",
+                                 name=self.name, policy=OVERFLOW_POLICY)
+        if OVERFLOW_POLICY == "disconnect":
+            self.queue.clear()
+            self.size = 0
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.waker.wake()
+        return False
+
+    def hold(self, other):
+        """Block policy: True if other must stop reading until we drain."""
+        with self.lock:
+            if other in self.paused:
+                return True
+            if self.size > QUEUE_HIGH and not self.closed:
+                self.paused.append(other)
+                return True
+            return False
+
+    def flush(self):
+        paused = ()
+        with self.lock:
+            queue = self.queue
+            while queue:
+                bufs = list(itertools.islice(queue, IOV_MAX))
+                try:
+                    n = sendv(self.conn, bufs)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    queue.clear()
+                    self.size = 0
+                    break
+                self.size -= n
+                for buf in bufs:
+                    if n < len(buf):
+                        queue[0] = memoryview(buf)[n:]
+                        break
+                    n -= len(buf)
+                    queue.popleft()
+                else:
                     continue
+                break  # socket full
+            if self.size <= QUEUE_LOW:
+                self.dropping = False
+                paused, self.paused = self.paused, []
+        for other in paused:
+            other.waker.wake()
+
+    def queued(self):
+        return bool(self.queue)
+
+    def close(self):
+        """Let paused senders go, flush what is still queued, drop the waker."""
+        with self.lock:
+            self.closed = True
+            paused, self.paused = self.paused, []
+        for other in paused:
+            other.waker.wake()
+        self.conn.settimeout(1.0)
+        self.flush()
+        self.waker.close()
+
+    def say(self, data):
+        """
+        Push protocol lines (b"SYS:...\n"), framed for a binary member. A raw
+        member gets none: they could land inside the partner's DATA chunk.
+        """
+        if self.raw:
+            return False
+        return self.push(*line_frames(data)) if self.binary else self.push(data)
+
+    def hang_up(self, line):
+        """
+        Send line, then stop reading: relay() sees EOF and ends the chat.
+        Only the first call does anything, so a chat ends with one reason.
+        """
+        with self.lock:
+            if self.ended is not None:
+                return
+            self.ended = line
+        self.say(line)
+        try:
+            self.conn.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+
+def rate_limit():
+    """A fresh RateLimit for a chatting connection, or None if there are no limits."""
+    if MSG_RATE or BYTE_RATE:
+        return RateLimit(MSG_RATE, MSG_BURST, BYTE_RATE, BYTE_BURST)
+    return None
+
+
+# ── timeouts ──
+
+def time_out(kind, who, end, line):
+    """Timer callback tail: count, log, and end a connection with line."""
+    TIMEOUTS.inc()
+    eventlog.info("timeout", f"[~] {who}: {kind} timeout", who=who, kind=kind)
+    end(line)
+
+
+def cut_conn(conn, line):
+    """
+    From the timer thread: send line if the socket takes it right away,
+    then stop reading, so a read_line() blocked on conn sees EOF.
+    """
+    try:
+        conn.send(line, getattr(socket, "MSG_DONTWAIT", 0))
+    except OSError:
+        pass
+    try:
+        conn.shutdown(socket.SHUT_RD)
+    except OSError:
+        pass
+
+
+def cut_writer(writer, line):
+    """cut_conn() for the asyncio engine."""
+    writer.write(line)
+    try:
+        writer.get_extra_info("socket").shutdown(socket.SHUT_RD)
+    except OSError:
+        pass
+
+
+class HandshakeTimer:
+    """
+    Ends a handshake HANDSHAKE_SECONDS after it began or, with
+    HANDSHAKE_MIN_RATE, as soon as the client has averaged fewer bytes a
+    second than that. call_later is the deadlines heap's or the event
+    loop's; end(line) is cut_conn() or cut_writer() for the connection.
+    """
+
+    def __init__(self, who, framer, call_later, end):
+        self.who        = who
+        self.framer     = framer
+        self.call_later = call_later
+        self.end        = end
+        self.started    = time.monotonic()
+        self.timer      = None
+        self.done       = False
+        self.schedule()
+
+    def schedule(self):
+        delays = []
+        if HANDSHAKE_SECONDS:
+            delays.append(self.started + HANDSHAKE_SECONDS - time.monotonic())
+        if HANDSHAKE_MIN_RATE:
+            delays.append(HANDSHAKE_CHECK)
+        if delays and not self.done:
+            self.timer = self.call_later(min(delays), self.check)
+
+    def check(self):
+        if self.done:
+            return
+        elapsed = time.monotonic() - self.started
+        if HANDSHAKE_SECONDS and elapsed >= HANDSHAKE_SECONDS:
+            time_out("handshake", self.who, self.end, TOO_SLOW)
+        elif HANDSHAKE_MIN_RATE and self.framer.received < HANDSHAKE_MIN_RATE * elapsed:
+            time_out("handshake rate", self.who, self.end, TOO_SLOW)
+        else:
+            self.schedule()
+
+    def cancel(self):
+        self.done = True
+        if self.timer is not None:
+            self.timer.cancel()
+
+
+def watch_chat(member, call_later):
+    """
+    Timer callback while member is chatting: hang up once no message has
+    gone either way for IDLE_SECONDS or it has chatted for SESSION_SECONDS,
+    else look again when the sooner of the two could be up. relay() keeps
+    member.active, for messages from the member and to it.
+    """
+    with chatting_lock:
+        if member not in chatting or member.ended is not None:
+            return  # the chat ended as this fired
+    now = time.monotonic()
+    due = []
+    if SESSION_SECONDS:
+        if now - member.since >= SESSION_SECONDS:
+            return time_out("session", member.name, member.hang_up, SESSION_OVER)
+        due.append(member.since + SESSION_SECONDS)
+    if IDLE_SECONDS:
+        if now - member.active >= IDLE_SECONDS:
+            return time_out("idle", member.name, member.hang_up,
+                            f"SYS:Chat idle for {IDLE_SECONDS:g}s. Goodbye!\n".encode())
+        due.append(member.active + IDLE_SECONDS)
+    if due:
+        member.timer = call_later(min(due) - now, watch_chat, member, call_later)
+
+
+# What str.strip() strips from an ASCII line; bytes.strip() alone leaves
+# \x1c-\x1f in place.
+STRIP = bytes(c for c in range(128) if chr(c).isspace())
+
+
+def clean_line(line):
+    """
+    A chat line as it is relayed: "\r"s dropped, surrounding whitespace
+    stripped, invalid UTF-8 left out. ASCII lines -- nearly all of them --
+    stay bytes throughout; others go through str for the same result.
+    """
+    line = line.replace(b"\r", b"")
+    if line.isascii():
+        return line.strip(STRIP)
+    return line.decode(errors="ignore").strip().encode()
 
-                if msg.lower() == "/quit":
+
+def new_framer(member):
+    """The read buffer for a chatting member: lines, or frames with OPT:binary."""
+    return FrameDecoder(MAX_LINE_BYTES) if member.binary else LineFramer(MAX_LINE_BYTES)
+
+
+class Batch:
+    """
+    The messages from one recv() of member, encoded once for each framing
+    its recipients use: text lines, binary frames, and frames for deflate
+    peers (ZMSG where compressing pays). With a room history, also one
+    whole frame per message for it to keep.
+    """
+
+    def __init__(self, member, targets, history=None):
+        self.member  = member
+        self.count   = 0
+        self.pause   = 0.0   # > 0: messages held back for the rate limit
+        self.text    = None  # a list once a recipient needs that framing
+        self.binary  = None
+        self.deflate = None
+        self.kept    = [] if history is not None else None
+        for peer in targets:
+            if peer.deflate:
+                self.deflate = []
+            elif peer.binary:
+                self.binary = []
+            else:
+                self.text = []
+
+    def add_line(self, msg):
+        """A message from a text sender, through clean_line()."""
+        self.count += 1
+        if self.text is not None:
+            self.text.append(self.member.line_prefix + msg + b"\n")
+        if self.binary is not None or self.deflate is not None or self.kept is not None:
+            self._frames(msg, None)
+
+    def add(self, body, z=None):
+        """A message from a binary sender; z if it came compressed (body is None)."""
+        self.count += 1
+        if body is None and (self.text is not None or self.binary is not None):
+            body = inflate(z, MAX_LINE_BYTES)
+            TRANSCODED.inc()
+        if self.text is not None:
+            prefix = self.member.line_prefix
+            for line in body.split(b"\n"):
+                msg = clean_line(line)
+                if msg:
+                    self.text.append(prefix + msg + b"\n")
+        self._frames(body, z)
+
+    def _frames(self, body, z):
+        member = self.member
+        if self.binary is not None:
+            self.binary += (varint(len(member.prefix) + len(body)) + member.prefix, body)
+        if self.deflate is not None:
+            if z is None and len(body) >= COMPRESS_MIN:
+                z = deflate(body, COMPRESS_LEVEL)
+                TRANSCODED.inc()
+                if len(z) >= len(body):
+                    z = None
+            if z is not None:
+                self.deflate += (varint(len(member.zprefix) + len(z)) + member.zprefix, z)
+            else:
+                self.deflate += (varint(len(member.prefix) + len(body)) + member.prefix, body)
+        if self.kept is not None:
+            # Compressed where we have it that way; the history is replayed
+            # far less often than it is added to.
+            prefix, data = (member.zprefix, z) if z is not None else (member.prefix, body)
+            if len(data) < HISTORY_BYTES:
+                self.kept.append(varint(len(prefix) + len(data)) + prefix + data)
+
+    def deliver(self, targets):
+        """Push the batch to each target in its framing."""
+        kinds = (self.text, self.binary, self.deflate)
+        if self.member.batch:
+            kinds = [[b"".join(bufs)] if bufs else None for bufs in kinds]
+        text, binary, zipped = ((bufs, sum(map(len, bufs))) if bufs else None
+                                for bufs in kinds)
+        for peer in targets:
+            out = zipped if peer.deflate else binary if peer.binary else text
+            if out is not None:
+                peer.push(*out[0])
+                BYTES_RELAYED.inc(out[1])
+
+
+def within_budget(batch, framer, items, limit, size=len):
+    """
+    The leading items (lines or frames) limit lets through now. The rest
+    go back to framer, and batch.pause says when the next one may go.
+    """
+    for i, item in enumerate(items):
+        pause = limit.take(size(item))
+        if pause:
+            framer.defer(items[i:])
+            batch.pause = pause
+            return items[:i]
+    return items
+
+
+def collect(member, framer, chunk, targets, history=None, limit=None):
+    """
+    Split chunk from member into a Batch for targets (and history);
+    returns (batch, quit). A text sender's lines are stripped and blank
+    ones skipped; a binary sender's frames are taken as they are. With a
+    limit, whatever is over budget stays in framer (see Batch.pause).
+    """
+    batch = Batch(member, targets, history)
+    if member.binary:
+        frames = framer.feed(chunk)
+        if limit is not None and frames:
+            frames = within_budget(batch, framer, frames, limit, lambda f: len(f[1]))
+        for ftype, body in frames:
+            if ftype == FRAME_QUIT:
+                return batch, True
+            if not body:
+                continue
+            if ftype == FRAME_MSG:
+                batch.add(body)
+            elif ftype == FRAME_ZMSG and member.deflate:
+                batch.add(None, body)
+        return batch, False
+
+    # Everyone reading text: add_line() inlined, as bots send a lot of lines.
+    # The history's frames are made afterwards, for the last lines only.
+    text = batch.text if batch.binary is None and batch.deflate is None else None
+    kept = batch.kept
+    prefix = member.line_prefix
+    quit = False
+    lines = framer.feed(chunk)
+    if limit is not None and lines:
+        lines = within_budget(batch, framer, lines, limit)
+    for line in lines:
+        if line.isascii():
+            msg = line.replace(b"\r", b"").strip(STRIP)  # clean_line(), inlined
+        else:
+            msg = clean_line(line)
+        if not msg:
+            continue
+
+        if len(msg) == 5 and msg.lower() == b"/quit":
+            quit = True
+            break
+
+        if text is not None:
+            text.append(prefix + msg + b"\n")
+            if kept is not None:
+                kept.append(msg)
+        else:
+            batch.add_line(msg)
+    if text is not None:
+        batch.count = len(text)
+        if kept:
+            fprefix = member.prefix
+            batch.kept = [varint(len(fprefix) + len(msg)) + fprefix + msg
+                          for msg in kept[-HISTORY_LINES:] if len(msg) < HISTORY_BYTES]
+    return batch, quit
+
+
+def relay(member, peers, stop_event=None, pending=b"", framer=None, history=None):
+    """
+    Read member's messages and push them to everyone in peers() except
+    member itself, as  MSG:<name>:<message>  (no echo), one push() per
+    recv() however many lines it held. Also flushes the
+    member's own outbox whenever its socket drains. A batch member is
+    read BATCH_READ bytes at a time, BATCH_DELAY apart while it streams.
+    Binary members send and get frames instead (see Batch). Messages are
+    added to history, if given, before anyone else can join.
+
+    Blocks in select() on the socket and the member's waker only (the stop
+    event rings the waker), so an idle connection costs no wakeups and a
+    stop ends this immediately. pending is whatever the member pipelined after its
+    handshake; a framer passed in keeps any unfinished line when this
+    returns. Over its rate limit the member isn't read from until it is
+    back within budget. Returns True if the member typed /quit.
+    """
+    conn = member.conn
+    framer = framer or new_framer(member)
+    sel = Selector()
+    watching = 0  # events conn is registered for
+    chunk = pending
+    received = time.perf_counter()
+    limit = rate_limit()
+    resume = 0.0       # monotonic time reads may start again
+    throttled = False
+    read_size = BATCH_READ if member.batch else 1024
+    # Holding the history's lock from reading peers() to keeping the
+    # messages means a joiner gets each of them once: replayed or live.
+    history_lock = history.lock if history is not None else contextlib.nullcontext()
+    with chatting_lock:
+        chatting[member] = stop_event
+        if moving and stop_event is not None:
+            stop_event.set()  # drain() began while we were pairing
+    member.since = member.active = time.monotonic()
+    watch_chat(member, deadlines.call_later)
+    try:
+        sel.register(member.waker, selectors.EVENT_READ)
+        if stop_event is not None:
+            stop_event.watch(member.waker)
+        while True:
+            # All messages from one recv() go to each peer in one push().
+            with history_lock:
+                targets = [peer for peer in peers() if peer is not member]
+                batch, quit = collect(member, framer, chunk, targets, history, limit)
+                if batch.kept:
+                    history.add(batch.kept)
+            if batch.count:
+                batch.deliver(targets)
+                for peer in targets:
+                    peer.active = member.active  # a chat is idle only both ways
+                MESSAGES_RELAYED.inc(batch.count)
+                RELAY_HOP.observe(time.perf_counter() - received)
+            if quit:
+                return True
+            if batch.pause:
+                # The rest waits in framer; the loop comes back for it
+                # once select() times out at resume.
+                resume = time.monotonic() + batch.pause
+                THROTTLE_PAUSE.observe(batch.pause)
+                if not throttled:
+                    THROTTLED.inc()
+                    member.say(SLOW_DOWN)
+                throttled = True
+            elif chunk or batch.count:
+                throttled = False
+            if member.batch and chunk:
+                # Let more of the stream pile up for the next recv().
+                resume = max(resume, time.monotonic() + BATCH_DELAY)
+
+            # Stop reading while a peer is over QUEUE_HIGH (block policy);
+            # its flush() rings our waker once it is under QUEUE_LOW.
+            held = OVERFLOW_POLICY == "block" and any(
+                peer.hold(member) for peer in targets)
+            wait = resume - time.monotonic() if resume else 0
+            events = 0 if held or wait > 0 else selectors.EVENT_READ
+            if member.queued():
+                events |= selectors.EVENT_WRITE
+            if events != watching:
+                if not watching:
+                    sel.register(conn, events)
+                elif not events:
+                    sel.unregister(conn)
+                else:
+                    sel.modify(conn, events)
+                watching = events
+
+            chunk = b""
+            for key, mask in sel.select(wait if wait > 0 else None):
+                if key.fileobj is member.waker:
+                    member.waker.drain()
+                    if stop_event is not None and stop_event.is_set():
+                        return False
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    member.flush()
+                if mask & selectors.EVENT_READ:
                     try:
-                        receiver.send(b"SYS:Partner has left the chat. Goodbye!\n")
-                    except:
-                        pass
-                    stop_event.set()
-                    return
+                        chunk = conn.recv(read_size)
+                    except BlockingIOError:
+                        continue
+                    if not chunk:
+                        return False
+                    received = time.perf_counter()
+                    member.active = time.monotonic()
 
-                # Send to receiver in a clean parseable format
-                # MSG:<sender_name>:<message>
+    except:
+        pass
+    finally:
+        sel.close()
+        with chatting_lock:
+            del chatting[member]
+        if member.timer is not None:
+            member.timer.cancel()
+    return False
+
+
+def relay_splice(member, partner, stop_event, pending=b""):
+    """
+    Raw relay for two "raw" peers: bytes move member -> pipe -> partner
+    with splice() and never enter Python. Each chunk reaches the partner as
+
+        DATA:<name>:<length>\n<length raw bytes>
+
+    There is no /quit here; a raw client leaves by closing its socket.
+    Timeouts and drain() reach raw pairs through chatting like any other,
+    but end them with plain EOF: no SYS: line goes into a raw stream.
+    """
+    sender, receiver = member.conn, partner.conn
+    header = f"DATA:{member.name}:".encode()
+    pipe_r, pipe_w = os.pipe()
+    sel = Selector()
+    waker = Waker()  # member's own was closed with it; see run_pair()
+    with chatting_lock:
+        chatting[member] = stop_event
+        if moving:
+            stop_event.set()  # drain() began while we were pairing
+    member.since = member.active = time.monotonic()
+    watch_chat(member, deadlines.call_later)
+    try:
+        if pending:
+            receiver.sendall(header + b"%d\n" % len(pending) + pending)
+        sender.settimeout(None)
+        sel.register(sender, selectors.EVENT_READ)
+        sel.register(waker, selectors.EVENT_READ)
+        stop_event.watch(waker)
+        while not stop_event.is_set():
+            ready = sel.select()
+            if any(key.fileobj is waker for key, _ in ready):
+                break  # only set() rings it
+
+            try:
+                n = os.splice(sender.fileno(), pipe_w, SPLICE_CHUNK)
+            except BlockingIOError:
+                continue
+            except OSError:
+                break
+
+            if not n:
+                break
+            received = time.perf_counter()
+            member.active = partner.active = time.monotonic()
+
+            receiver.sendall(header + b"%d\n" % n)
+            BYTES_RELAYED.inc(n)
+            while n:
                 try:
-                    receiver.send(f"MSG:{sender_name}:{msg}\n".encode())
-                except:
-                    stop_event.set()
-                    return
+                    n -= os.splice(pipe_r, receiver.fileno(), n)
+                except BlockingIOError:
+                    # receiver still has a timeout set, i.e. O_NONBLOCK
+                    select.select([], [receiver], [])
+            RELAY_HOP.observe(time.perf_counter() - received)
 
     except:
         pass
     finally:
+        sel.close()
+        os.close(pipe_r)
+        os.close(pipe_w)
         stop_event.set()
+        waker.close()
+        with chatting_lock:
+            del chatting[member]
+        if member.timer is not None:
+            member.timer.cancel()
 
 
-def send_msg(conn, msg):
+def send_msg(conn, *msgs):
+    """Send one or more lines in a single syscall."""
     try:
-        conn.send((msg + "\n").encode())
+        sendv(conn, [(msg + "\n").encode() for msg in msgs])
         return True
     except:
         return False
 
 
-def handle_client(conn, addr):
-    print(f"[+] Connection from {addr}")
+def negotiate(line, opts, supported):
+    """Handle an "OPT:<option>" line at the name prompt; returns the reply."""
+    opt = line[4:].strip().lower()
+    if opt in supported:
+        opts.add(opt)
+        if opt == "deflate":
+            opts.add("binary")  # ZMSG frames need binary framing
+        return f"OPT:{opt}:on"
+    return f"OPT:{opt}:off"
+
+
+def reject(conn, addr, reason):
+    """Turn a connection away from the accept loop: one line, then close."""
+    CONNECTIONS_REJECTED.inc()
+    eventlog.warning("reject", f"[!] Rejected {addr}: {reason}", addr=addr, reason=reason)
+    try:
+        conn.setblocking(False)
+        conn.send(BUSY)
+    except OSError:
+        pass
+    conn.close()
+
+
+def handshake(conn, addr, accepted):
+    """
+    Prompt for a name (and options) and a room code. Returns
+    (name, room_id, opts, pending) or None if the client went away or ran
+    out of time.
+    """
+    framer = LineFramer(HANDSHAKE_MAX_LINE, cr=True)
+    timer = HandshakeTimer(addr, framer, deadlines.call_later,
+                           lambda line: cut_conn(conn, line))
     try:
-        send_msg(conn, "SYS:Welcome to NormansChat!")
-        send_msg(conn, "PROMPT:name")
+        return handshake_steps(conn, framer, accepted)
+    finally:
+        timer.cancel()
 
-        name = read_line(conn)
+
+def handshake_steps(conn, framer, accepted):
+    send_msg(conn, "SYS:Welcome to NormansChat!", "PROMPT:name")
+    HANDSHAKE_PROMPT.observe(time.perf_counter() - accepted)
+
+    opts = set()
+    while True:
+        name = read_line(conn, framer)
         if not name:
-            return
-        name = name.strip()
-        send_msg(conn, f"SYS:Hello {name}!")
+            return None
+        if not name.upper().startswith("OPT:"):
+            break
+        send_msg(conn, negotiate(name, opts, THREAD_OPTIONS), "PROMPT:name")
+    name = name.strip()
+    send_msg(conn, f"SYS:Hello {name}!", "PROMPT:room")
+
+    room_id = read_line(conn, framer)
+    if not room_id:
+        return None
+    return name, room_id.strip().upper(), opts, framer.pending()
 
-        send_msg(conn, "PROMPT:room")
 
-        room_id = read_line(conn)
-        if not room_id:
+def handle_client(conn, addr, accepted):
+    """Serve a connection admission let in; see serve_threads()."""
+    eventlog.info("connect", f"[+] Connection from {addr}", addr=addr)
+    CONNECTIONS.inc()
+    CONNECTIONS_OPEN.inc()
+    try:
+        try:
+            hello = handshake(conn, addr, accepted)
+        finally:
+            admission.handshake_done()
+        if hello is None:
+            HANDSHAKE_FAILURES.inc()
             return
-        room_id = room_id.strip().upper()
+        enter_room(conn, *hello)
+
+    except Exception as e:
+        eventlog.error("error", f"[ERROR] {addr}: {e}", addr=addr, error=str(e))
+    finally:
+        CONNECTIONS_OPEN.dec()
+        admission.leave(addr[0])
+        try:
+            conn.close()
+        except:
+            pass
+
+
+def adopt_client(conn, name, room_id, info):
+    """Serve a client another worker handed over after its handshake."""
+    eventlog.info("adopt", f"[>] {name} moved here for room [{room_id}]",
+                  name=name, room=room_id)
+    CONNECTIONS_OPEN.inc()
+    try:
+        enter_room(conn, name, room_id, set(info.get("opts", ())),
+                   info.get("pending", "").encode("latin-1"))
+    except Exception as e:
+        eventlog.error("error", f"[ERROR] {name}: {e}", name=name, error=str(e))
+    finally:
+        CONNECTIONS_OPEN.dec()
+        try:
+            conn.close()
+        except:
+            pass
 
-        joining = False
-        entry   = None
 
+def handoff_info(opts, pending):
+    """Per-connection state that travels with a client to another worker."""
+    return {"opts": sorted(opts), "pending": pending.decode("latin-1")}
+
+
+def enter_room(conn, name, room_id, opts, pending=b""):
+    """
+    Create or join room_id and relay until the chat ends. pending holds
+    bytes the client sent after its room code; they are relayed first.
+    """
+    if draining:
+        return move_client(conn, name, room_id, opts, pending)
+    if ROOM_SIZE > 2:
+        return enter_group(conn, name, room_id, opts, pending)
+
+    started = time.perf_counter()
+    rooms, rooms_lock = room_shard(room_id)
+    while True:
         with rooms_lock:
-            if room_id in rooms:
-                entry   = rooms.pop(room_id)
-                joining = True
-            else:
-                event = threading.Event()
-                entry = {
-                    "conn":         conn,
-                    "name":         name,
-                    "event":        event,
-                    "partner_conn": None,
-                    "partner_name": None,
-                    "created_at":   time.time()
-                }
-                rooms[room_id] = entry
-
-        if not joining:
-            mins = TIMEOUT_SECONDS // 60
-            send_msg(conn, f"SYS:Room [{room_id}] created! Waiting for partner...")
-            send_msg(conn, f"SYS:Room closes in {mins} mins if nobody joins.")
+            if broker is None or broker.claim(room_id):
+                if room_id in rooms:
+                    entry   = rooms.pop(room_id)
+                    joining = True
+                    if broker is not None:
+                        broker.release(room_id)
+                    ROOMS_WAITING.dec()
+                    ROOMS_ACTIVE.inc()
+                else:
+                    event = threading.Event()
+                    entry = {
+                        "conn":         conn,
+                        "name":         name,
+                        "opts":         opts,
+                        "event":        event,
+                        "partner_conn": None,
+                        "partner_name": None,
+                        "partner_opts": None,
+                        "stop_event":   None,
+                        "created_at":   time.time()
+                    }
+                    entry["timer"] = deadlines.call_later(
+                        TIMEOUT_SECONDS, expire_room, room_id, entry)
+                    rooms[room_id] = entry
+                    joining = False
+                    ROOMS_WAITING.inc()
+                break
+        # The room lives in another worker; the caller closes our copy.
+        if broker.handoff(conn.fileno(), name, room_id, handoff_info(opts, pending)):
+            return
+
+    if not joining:
+        mins = TIMEOUT_SECONDS // 60
+        send_msg(conn, f"SYS:Room [{room_id}] created! Waiting for partner...",
+                 f"SYS:Room closes in {mins} mins if nobody joins.")
 
-            fired = entry["event"].wait(timeout=TIMEOUT_SECONDS)
+        # Set by the joiner, or by expire_room() when the deadline passes.
+        entry["event"].wait()
+        ROOM_WAIT.observe(time.perf_counter() - started)
 
-            if not fired or entry.get("partner_conn") is None:
-                with rooms_lock:
-                    rooms.pop(room_id, None)
+        if entry["partner_conn"] is None:
+            if draining:
+                move_client(conn, name, room_id, opts, pending)
+            else:
                 send_msg(conn, "SYS:No one joined. Room closed. Goodbye!")
-                return
+            return
 
-            partner_conn = entry["partner_conn"]
-            partner_name = entry["partner_name"]
+        partner, member = entry["members"]
+        partner_name = entry["partner_name"]
+        partner_opts = entry["partner_opts"]
 
-            send_msg(conn, f"CONNECTED:{partner_name}")
+        # A binary client reads frames after its first CONNECTED: line; the
+        # joiner sent that one before any frame could follow it.
+        if not member.binary:
+            member.push(f"CONNECTED:{partner_name}\n".encode())
+        PAIRING.observe(time.perf_counter() - started)
 
-        else:
-            partner_conn = entry["conn"]
-            partner_name = entry["name"]
+    else:
+        entry["timer"].cancel()
+        partner_name = entry["name"]
+        partner_opts = entry["opts"]
 
-            entry["partner_conn"] = conn
-            entry["partner_name"] = name
-            entry["event"].set()
+        # Both outboxes exist before either side can push to the other.
+        member  = Member(conn, name, opts)
+        partner = Member(entry["conn"], partner_name, partner_opts)
+        entry["members"]      = (member, partner)
+        entry["partner_conn"] = conn
+        entry["partner_name"] = name
+        entry["partner_opts"] = opts
+        entry["stop_event"]   = StopEvent()
+        entry["parked"]       = []  # sides waiting in move_pair()
+        entry["parked_lock"]  = threading.Lock()
+        entry["moved"]        = threading.Event()
+        entry["event"].set()
 
-            send_msg(conn, f"CONNECTED:{partner_name}")
-            # Also notify the waiting person
-            try:
-                partner_conn.send(f"CONNECTED:{name}\n".encode())
-            except:
-                pass
+        member.push(f"CONNECTED:{partner_name}\n".encode())
+        PAIRING.observe(time.perf_counter() - started)
+        # Also notify the waiting person
+        partner.push(f"CONNECTED:{name}\n".encode())
+
+    run_pair(room_id, entry, member, partner, opts, partner_opts, pending, joining)
+
+
+def run_pair(room_id, entry, member, partner, opts, partner_opts, pending, counted):
+    """
+    Relay member's side of a pair until the chat ends. Each side runs this
+    on its own thread; the shared stop event tears down the other side as
+    soon as one finishes. The counted side takes the room off ROOMS_ACTIVE.
+    """
+    stop_event = entry["stop_event"]
+    raw = "raw" in opts and "raw" in partner_opts
+    framer = new_framer(member)
+    quit = False
+    try:
+        if raw:
+            member.raw = True
+            member.close()  # splice() writes to the sockets directly
+            relay_splice(member, partner, stop_event, pending)
+        elif relay(member, lambda: (partner,), stop_event, pending, framer):
+            quit = True
+            partner.say(b"SYS:Partner has left the chat. Goodbye!\n")
+        elif member.ended is not None:
+            partner.hang_up(member.ended)  # a timeout ends the chat for both
+    finally:
+        stop_event.set()
+        member.close()
+        if counted:
+            ROOMS_ACTIVE.dec()
+
+    if moving and move_pair(room_id, entry, member, opts, framer.pending(), quit):
+        return
+    eventlog.info("chat_end", f"[-] Chat ended: [{room_id}] {member.name} <-> {partner.name}",
+                  room=room_id, name=member.name, partner=partner.name)
 
-            time.sleep(0.2)
 
-        # Start relay threads
-        stop_event = threading.Event()
-        t1 = threading.Thread(target=relay, args=(conn,         partner_conn, name,         stop_event), daemon=True)
-        t2 = threading.Thread(target=relay, args=(partner_conn, conn,         partner_name, stop_event), daemon=True)
-        t1.start()
-        t2.start()
-        stop_event.wait()
+def move_pair(room_id, entry, member, opts, pending, quit):
+    """
+    Live handoff of one side of a pair drain() stopped. The second side to
+    get here passes both sockets to the successor; the first waits for
+    that, so its socket stays open meanwhile. True if the pair moved.
+    """
+    with entry["parked_lock"]:
+        parked = entry["parked"]
+        parked.append((member.conn, {"name": member.name, "opts": sorted(opts),
+                                     "pending": pending.decode("latin-1")}, quit))
+        last = len(parked) == 2
+    if not last:
+        # The partner may have ended the chat before the drain began.
+        return entry["moved"].wait(5) and entry["moved_ok"]
+
+    moved = False
+    try:
+        if not any(quit for _, _, quit in parked):
+            moved = successor.send({"op": "pair", "room": room_id,
+                                    "sides": [side for _, side, _ in parked]},
+                                   [conn for conn, _, _ in parked])
+    finally:
+        entry["moved_ok"] = moved
+        entry["moved"].set()
+    if moved:
+        a, b = (side["name"] for _, side, _ in parked)
+        eventlog.info("move", f"[>] Chat [{room_id}] {a} <-> {b} moved to pid {successor.pid}",
+                      room=room_id, names=[a, b], pid=successor.pid)
+    return moved
 
-        print(f"[-] Chat ended: [{room_id}] {name} <-> {partner_name}")
 
+def move_client(conn, name, room_id, opts, pending):
+    """
+    Draining: pass a client that isn't chatting yet to the successor, or
+    say goodbye if there is none. The caller closes its copy of conn.
+    """
+    msg = {"op": "client", "name": name, "room": room_id,
+           "info": handoff_info(opts, pending)}
+    if successor is not None and successor.send(msg, [conn]):
+        eventlog.info("move", f"[>] {name} moved to pid {successor.pid} for room [{room_id}]",
+                      name=name, room=room_id, pid=successor.pid)
+        return
+    send_msg(conn, SHUTDOWN_GOODBYE)
+
+
+def adopt_pair(room_id, conns, sides):
+    """Resume a pair the previous server process passed over mid-chat."""
+    members = [Member(conn, side["name"], side["opts"])
+               for conn, side in zip(conns, sides)]
+    entry = {
+        "stop_event":  StopEvent(),
+        "parked":      [],
+        "parked_lock": threading.Lock(),
+        "moved":       threading.Event(),
+        "created_at":  time.time()
+    }
+    ROOMS_ACTIVE.inc()
+    eventlog.info("adopt", f"[>] Chat [{room_id}] {members[0].name} <-> {members[1].name} "
+                  "moved here", room=room_id, names=[m.name for m in members])
+    for i in (0, 1):
+        args = (room_id, entry, members[i], members[1 - i], set(sides[i]["opts"]),
+                set(sides[1 - i]["opts"]), sides[i]["pending"].encode("latin-1"), i == 0)
+        threading.Thread(target=resume_pair, args=args, daemon=True).start()
+
+
+def resume_pair(room_id, entry, member, *args):
+    """One side of an adopted pair: run_pair() with adopt_client()'s bookkeeping."""
+    CONNECTIONS_OPEN.inc()
+    try:
+        run_pair(room_id, entry, member, *args)
     except Exception as e:
-        print(f"[ERROR] {addr}: {e}")
+        eventlog.error("error", f"[ERROR] {member.name}: {e}", name=member.name, error=str(e))
     finally:
+        CONNECTIONS_OPEN.dec()
         try:
-            conn.close()
+            member.conn.close()
         except:
             pass
 
 
-def cleanup_expired_rooms():
-    while True:
-        time.sleep(30)
-        now = time.time()
+# ── group rooms (--room-size > 2) ──
+#
+# A group room stays in the directory while it has members, so people can
+# come and go. Each line is encoded once and the same bytes go to every
+# other member's push(). Membership changes happen under the room's shard
+# lock; broadcasts just read the current members tuple.
+
+class History:
+    """
+    A group room's last messages as whole binary MSG (or ZMSG) frames,
+    the most compact form we have, oldest first. Relays add() what they
+    relay and group_add() pushes replay() to a joiner as one buffer; both
+    under lock. A room stays within HISTORY_LINES and HISTORY_BYTES by
+    dropping its oldest frames, and drops as much as it adds while all
+    rooms together keep more than HISTORY_TOTAL. Nothing is allocated
+    until the room has a message.
+    """
+    __slots__ = ("frames", "size", "lock")
+
+    def __init__(self):
+        self.frames = None
+        self.size   = 0
+        self.lock   = threading.Lock()
+
+    def add(self, frames):
+        kept = self.frames
+        if kept is None:
+            kept = self.frames = collections.deque(maxlen=HISTORY_LINES)
+        if len(frames) > HISTORY_LINES:
+            frames = frames[-HISTORY_LINES:]
+        # extend() drops the oldest past maxlen itself; count them first.
+        evicted = len(kept) + len(frames) - HISTORY_LINES
+        dropped = sum(map(len, itertools.islice(kept, evicted))) if evicted > 0 else 0
+        added = sum(map(len, frames))
+        kept.extend(frames)
+        size = self.size + added
+        HISTORY_SIZE.inc(added)
+        over = HISTORY_SIZE.value - HISTORY_TOTAL
+        while kept and (size - dropped > HISTORY_BYTES or dropped < over):
+            dropped += len(kept.popleft())
+        self.size = size - dropped
+        if dropped:
+            HISTORY_SIZE.dec(dropped)
+        if not kept:
+            self.frames = None
+
+    def clear(self):
+        HISTORY_SIZE.dec(self.size)
+        self.frames = None
+        self.size   = 0
+
+    def replay(self, member):
+        """
+        The kept messages in member's framing, as one buffer. A compressed
+        message that won't inflate (deflate peers pass them on unchecked)
+        is left out for text and binary members.
+        """
+        if not self.frames:
+            return b""
+        data = b"".join(self.frames)
+        if not member.deflate:
+            # Only deflate peers read ZMSG; text peers read lines.
+            out = []
+            for ftype, body in FrameDecoder(len(data)).feed(data):
+                name, msg = split_msg(body)
+                if ftype == FRAME_ZMSG:
+                    try:
+                        msg = inflate(msg, MAX_LINE_BYTES)
+                    except BadFrame:
+                        continue
+                if member.binary:
+                    prefix = bytes((FRAME_MSG,)) + varint(len(name)) + name
+                    out += (varint(len(prefix) + len(msg)), prefix, msg)
+                else:
+                    for line in msg.split(b"\n"):
+                        line = clean_line(line)
+                        if line:
+                            out.append(b"MSG:" + name + b":" + line + b"\n")
+            data = b"".join(out)
+        return data
+
+
+def group_add(entry, member):
+    """
+    Add member to the room, welcome it and replay the room's history to
+    it; False if the room is full. The waiting creator gets its CONNECTED
+    line on the first join; later joins are announced with say(), framed
+    for each member. Call under the shard lock.
+    """
+    members = entry["members"]
+    if len(members) >= ROOM_SIZE:
+        return False
+    history = entry["history"]
+    with history.lock if history is not None else contextlib.nullcontext():
+        # Everything that can fail happens before member is in the room.
+        replay = history.replay(member) if history is not None else b""
+        entry["members"] = members + (member,)
+        # Only the first join; a room back down to one member is not waiting.
+        if not entry["event"].is_set():
+            entry["timer"].cancel()
+            # Welcome the waiting creator before anyone can send it a message.
+            group_welcome(entry, members[0])
+            entry["event"].set()
+            ROOMS_WAITING.dec()
+            ROOMS_ACTIVE.inc()
+        else:
+            group_broadcast(entry, f"SYS:{member.name} joined the room.\n".encode(), member)
+        group_welcome(entry, member)
+        if replay:
+            member.push(replay)
+            BYTES_RELAYED.inc(len(replay))
+    return True
+
+
+def group_broadcast(entry, data, sender=None):
+    for member in entry["members"]:
+        if member is not sender:
+            member.say(data)
+
+
+def group_leave(room_id, entry, member):
+    rooms, rooms_lock = room_shard(room_id)
+    with rooms_lock:
+        members = tuple(m for m in entry["members"] if m is not member)
+        entry["members"] = members
+        if not members and rooms.get(room_id) is entry:
+            del rooms[room_id]
+            if broker is not None:
+                broker.release(room_id)
+            if entry["history"] is not None:
+                entry["history"].clear()
+            ROOMS_ACTIVE.dec()
+    if members:
+        group_broadcast(entry, f"SYS:{member.name} has left the chat.\n".encode())
+
+
+def group_welcome(entry, member):
+    """CONNECTED line for a member who is in the room with others now."""
+    names = ", ".join(m.name for m in entry["members"] if m is not member)
+    member.push(f"CONNECTED:{names}\n".encode())
+
+
+def enter_group(conn, name, room_id, opts, pending):
+    started = time.perf_counter()
+    rooms, rooms_lock = room_shard(room_id)
+    member = Member(conn, name, opts)
+    try:
+        while True:
+            with rooms_lock:
+                if broker is None or broker.claim(room_id):
+                    entry = rooms.get(room_id)
+                    creating = entry is None
+                    if creating:
+                        entry = {
+                            "members":    (member,),
+                            "event":      threading.Event(),
+                            "history":    History() if HISTORY_LINES else None,
+                            "created_at": time.time()
+                        }
+                        entry["timer"] = deadlines.call_later(
+                            TIMEOUT_SECONDS, expire_room, room_id, entry)
+                        rooms[room_id] = entry
+                        ROOMS_WAITING.inc()
+                        full = False
+                    else:
+                        full = not group_add(entry, member)
+                    break
+            if broker.handoff(conn.fileno(), name, room_id, handoff_info(opts, pending)):
+                return
+
+        if full:
+            member.push(f"SYS:Room [{room_id}] is full. Goodbye!\n".encode())
+            return
+
+        try:
+            if creating:
+                mins = TIMEOUT_SECONDS // 60
+                member.push(f"SYS:Room [{room_id}] created! Waiting for others...\n"
+                            f"SYS:Room closes in {mins} mins if nobody joins.\n".encode())
+                entry["event"].wait()
+                ROOM_WAIT.observe(time.perf_counter() - started)
+                if len(entry["members"]) < 2:
+                    if draining:
+                        move_client(conn, name, room_id, opts, pending)
+                    else:
+                        member.push(b"SYS:No one joined. Room closed. Goodbye!\n")
+                    return
+            PAIRING.observe(time.perf_counter() - started)
+
+            relay(member, lambda: entry["members"], None, pending, history=entry["history"])
+        finally:
+            group_leave(room_id, entry, member)
+        eventlog.info("leave", f"[-] {name} left [{room_id}]", name=name, room=room_id)
+    finally:
+        member.close()
+
+
+def close_room(room_id, entry):
+    """
+    Take a room nobody joined out of the directory and wake its waiting
+    creator. False if someone joined meanwhile.
+    """
+    rooms, rooms_lock = room_shard(room_id)
+    with rooms_lock:
+        if rooms.get(room_id) is not entry or entry["event"].is_set():
+            return False
+        del rooms[room_id]
+        if broker is not None:
+            broker.release(room_id)
+    ROOMS_WAITING.dec()
+    entry["event"].set()
+    return True
+
+
+def expire_room(room_id, entry):
+    """Timer callback: close a room nobody joined in time."""
+    if close_room(room_id, entry):
+        ROOMS_EXPIRED.inc()
+        eventlog.info("expire", f"[~] Room [{room_id}] expired.", room=room_id)
+
+
+def waiting_rooms():
+    """(room_id, entry) for every room still waiting for someone to join."""
+    found = []
+    for rooms, rooms_lock in room_shards:
         with rooms_lock:
-            expired = [c for c, e in rooms.items() if now - e.get("created_at", now) > TIMEOUT_SECONDS]
-            for code in expired:
-                e = rooms.pop(code)
-                try:
-                    e["conn"].send(b"SYS:Room expired. No one joined. Goodbye!\n")
-                    e["conn"].close()
-                except:
-                    pass
-                print(f"[~] Room [{code}] expired.")
+            found.extend((room_id, entry) for room_id, entry in rooms.items()
+                         if not entry["event"].is_set())
+    return found
 
 
-def main():
-    print(BANNER)
-    threading.Thread(target=cleanup_expired_rooms, daemon=True).start()
+# ── graceful shutdown ──
+#
+# SIGTERM or Ctrl-C (or a new process taking over with --handoff) closes
+# the listener and drains: rooms nobody joined yet are closed, and live
+# chats either move to the successor or get DRAIN_SECONDS to finish before
+# whoever is left is cut off with a goodbye.
+
+def stop_accepting(signum, frame):
+    """SIGINT/SIGTERM on the thread engine: end the accept loop, once."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def hand_over(new):
+    """handoff.offer() callback: a new server process has our listener now."""
+    global successor
+    successor = new
+    eventlog.info("shutdown", f"[*] pid {new.pid} took over the listener.", pid=new.pid)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def begin_drain(move_pairs):
+    """
+    With the listener closed: close rooms nobody joined (their creators
+    move to the successor, if any), then either move every live pair to the
+    successor (move_pairs) or warn everyone chatting that the end is near.
+    """
+    global draining, moving
+    draining = True
+    eventlog.info("shutdown", f"[*] Shutting down: {CONNECTIONS_OPEN.value} connections "
+                  f"open, giving chats {DRAIN_SECONDS:g}s to end.",
+                  open=CONNECTIONS_OPEN.value, drain_seconds=DRAIN_SECONDS)
+    for room_id, entry in waiting_rooms():
+        close_room(room_id, entry)
+
+    with chatting_lock:
+        moving = move_pairs
+        live = list(chatting.items())
+    if moving:
+        for member, stop_event in live:
+            stop_event.set()
+    else:
+        notice = f"SYS:Server is shutting down; this chat ends in {DRAIN_SECONDS:g}s.\n".encode()
+        for member, _ in live:
+            member.say(notice)
+
+
+def cut_off():
+    """Drain deadline: end every chat still going, with a goodbye."""
+    with chatting_lock:
+        live = list(chatting)
+    goodbye = (SHUTDOWN_GOODBYE + "\n").encode()
+    for member in live:
+        member.hang_up(goodbye)
+
+
+def end_drain():
+    if successor is not None:
+        successor.close()
+    if CONNECTIONS_OPEN.value:
+        eventlog.warning("shutdown", f"[!] Closing {CONNECTIONS_OPEN.value} connections "
+                         "still open.", open=CONNECTIONS_OPEN.value)
+    else:
+        eventlog.info("shutdown", "[*] Drained.")
 
+
+def drain():
+    """Thread engine shutdown, after the accept loop: see begin_drain()."""
+    deadline = time.monotonic() + DRAIN_SECONDS
+    begin_drain(successor is not None and successor.live and ROOM_SIZE == 2)
+    while CONNECTIONS_OPEN.value and time.monotonic() < deadline:
+        time.sleep(0.1)
+    if CONNECTIONS_OPEN.value:
+        cut_off()
+        deadline = time.monotonic() + 1
+        while CONNECTIONS_OPEN.value and time.monotonic() < deadline:
+            time.sleep(0.05)
+    end_drain()
+
+
+def default_backlog():
+    """The kernel's cap on listen() backlogs; asking for more gets cut to it."""
+    try:
+        with open("/proc/sys/net/core/somaxconn") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return socket.SOMAXCONN
+
+
+LISTEN_BACKLOG = default_backlog()
+
+
+def open_listener(reuse_port=False):
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    tune_listener(server)
     server.bind(("0.0.0.0", 9999))
-    server.listen(100)
-    print("[*] Listening on port 9999...")
-    print(f"[*] Rooms expire after {TIMEOUT_SECONDS // 60} mins if empty.\n")
+    server.listen(LISTEN_BACKLOG)
+    return server
+
+
+def tune_listener(server):
+    refused = sockopts.tune_listener(server, SOCKET_OPTIONS)
+    if refused:
+        print(f"[!] Socket options not supported here: {', '.join(refused)}")
+
+
+def serve_threads(server):
+    global deadlines
+    deadlines = TimerHeap("deadlines")
+    adopt = lambda conn, name, room_id, info: threading.Thread(
+        target=adopt_client, args=(conn, name, room_id, info), daemon=True).start()
+    if broker is not None:
+        broker.listen(adopt)
+    if predecessor is not None:
+        handoff.adopt(predecessor, adopt, adopt_pair)
+    threading.stack_size(THREAD_STACK)
 
     while True:
         try:
             conn, addr = server.accept()
-            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+            accepted = time.perf_counter()
+            reason = admission.admit(addr[0])
+            if reason is not None:
+                reject(conn, addr, reason)
+                continue
+            try:
+                sockopts.tune_conn(conn, SOCKET_OPTIONS)
+                threading.Thread(target=handle_client, args=(conn, addr, accepted),
+                                 daemon=True).start()
+            except (OSError, RuntimeError) as e:
+                # RuntimeError: can't start new thread, the very overload
+                # admission is there for. Give the slot back; conn is ours.
+                admission.handshake_done()
+                admission.leave(addr[0])
+                reject(conn, addr, f"no thread: {e}")
         except KeyboardInterrupt:
-            print("\n[*] Shutting down.")
             break
         except Exception as e:
-            print(f"[ERROR] {e}")
+            eventlog.error("error", f"[ERROR] {e}", error=str(e))
+
+    server.close()
+    drain()
+
+
+# ── asyncio engine ───────────────────────────────────────────────────────────
+#
+# Same protocol as above, but every connection is a coroutine on one event
+# loop instead of a handful of OS threads. The room directory is shared with
+# the thread engine (only one engine runs per process); its shard locks are
+# skipped here because everything touching it runs on the loop thread.
+
+async def read_line_async(reader, framer):
+    """Async twin of read_line(). Returns string or None on error."""
+    try:
+        while True:
+            line = framer.next_line()
+            if line is not None:
+                return line.decode(errors="ignore").strip()
+            chunk = await reader.read(1024)
+            if not chunk:
+                return None
+            framer.push(chunk)
+    except:
+        return None
+
+
+async def send_msg_async(writer, *msgs):
+    try:
+        writer.write("".join(msg + "\n" for msg in msgs).encode())
+        await writer.drain()
+        return True
+    except:
+        return False
+
+
+async def relay_async(reader, member, peers, pending=b"", history=None):
+    """
+    Async twin of relay(). Under the block policy this waits in drain()
+    while a peer's transport is over QUEUE_HIGH, which stops reading from
+    the member; so does sleeping off a rate limit. Returns True if the
+    member typed /quit.
+    """
+    framer = new_framer(member)
+    chunk = pending
+    received = time.perf_counter()
+    limit = rate_limit()
+    throttled = False
+    read_size = BATCH_READ if member.batch else 1024
+    chatting[member] = None  # loop thread only; no lock needed
+    member.since = member.active = time.monotonic()
+    watch_chat(member, asyncio.get_running_loop().call_later)
+    try:
+        while True:
+            targets = [peer for peer in peers() if peer is not member]
+            batch, quit = collect(member, framer, chunk, targets, history, limit)
+            if batch.kept:
+                history.add(batch.kept)
+            if batch.count:
+                batch.deliver(targets)
+                for peer in targets:
+                    peer.active = member.active  # a chat is idle only both ways
+                MESSAGES_RELAYED.inc(batch.count)
+                RELAY_HOP.observe(time.perf_counter() - received)
+                if OVERFLOW_POLICY == "block":
+                    for peer in targets:
+                        await peer.drained()
+            if quit:
+                return True
+            if batch.pause:
+                THROTTLE_PAUSE.observe(batch.pause)
+                if not throttled:
+                    THROTTLED.inc()
+                    member.say(SLOW_DOWN)
+                throttled = True
+                # Not reading lets the transport stop too once the
+                # reader's buffer is full. Then collect what was held back.
+                await asyncio.sleep(batch.pause)
+                chunk = b""
+                continue
+            if chunk or batch.count:
+                throttled = False
+            if member.batch and chunk:
+                await asyncio.sleep(BATCH_DELAY)
+
+            chunk = await reader.read(read_size)
+            if not chunk:
+                return False
+            received = time.perf_counter()
+            member.active = time.monotonic()
+
+    except:
+        pass
+    finally:
+        del chatting[member]
+        if member.timer is not None:
+            member.timer.cancel()
+    return False
+
+
+async def handshake_async(reader, writer, addr, accepted):
+    """Async twin of handshake()."""
+    framer = LineFramer(HANDSHAKE_MAX_LINE, cr=True)
+    timer = HandshakeTimer(addr, framer, asyncio.get_running_loop().call_later,
+                           lambda line: cut_writer(writer, line))
+    try:
+        return await handshake_steps_async(reader, writer, framer, accepted)
+    finally:
+        timer.cancel()
+
+
+async def handshake_steps_async(reader, writer, framer, accepted):
+    await send_msg_async(writer, "SYS:Welcome to NormansChat!", "PROMPT:name")
+    HANDSHAKE_PROMPT.observe(time.perf_counter() - accepted)
+
+    opts = set()
+    while True:
+        name = await read_line_async(reader, framer)
+        if not name:
+            return None
+        if not name.upper().startswith("OPT:"):
+            break
+        await send_msg_async(writer, negotiate(name, opts, ASYNC_OPTIONS), "PROMPT:name")
+    name = name.strip()
+    await send_msg_async(writer, f"SYS:Hello {name}!", "PROMPT:room")
+
+    room_id = await read_line_async(reader, framer)
+    if not room_id:
+        return None
+    return name, room_id.strip().upper(), opts, framer.pending()
+
+
+async def handle_client_async(reader, writer):
+    accepted = time.perf_counter()
+    addr = writer.get_extra_info("peername")
+    # Admission happens here rather than in the accept loop, which asyncio
+    # owns; a task costs little next to a thread.
+    reason = admission.admit(addr[0])
+    if reason is not None:
+        CONNECTIONS_REJECTED.inc()
+        eventlog.warning("reject", f"[!] Rejected {addr}: {reason}", addr=addr, reason=reason)
+        writer.write(BUSY)
+        writer.close()
+        return
+    sockopts.tune_conn(writer.get_extra_info("socket"), SOCKET_OPTIONS)
+
+    eventlog.info("connect", f"[+] Connection from {addr}", addr=addr)
+    CONNECTIONS.inc()
+    CONNECTIONS_OPEN.inc()
+    try:
+        try:
+            hello = await handshake_async(reader, writer, addr, accepted)
+        finally:
+            admission.handshake_done()
+        if hello is None:
+            HANDSHAKE_FAILURES.inc()
+            return
+        await enter_room_async(reader, writer, *hello)
+
+    except Exception as e:
+        eventlog.error("error", f"[ERROR] {addr}: {e}", addr=addr, error=str(e))
+    finally:
+        CONNECTIONS_OPEN.dec()
+        admission.leave(addr[0])
+        writer.close()
+
+
+async def adopt_client_async(conn, name, room_id, info):
+    """Serve a client another worker handed over after its handshake."""
+    eventlog.info("adopt", f"[>] {name} moved here for room [{room_id}]",
+                  name=name, room=room_id)
+    reader, writer = await asyncio.open_connection(sock=conn)
+    CONNECTIONS_OPEN.inc()
+    try:
+        await enter_room_async(reader, writer, name, room_id, set(info.get("opts", ())),
+                               info.get("pending", "").encode("latin-1"))
+    except Exception as e:
+        eventlog.error("error", f"[ERROR] {name}: {e}", name=name, error=str(e))
+    finally:
+        CONNECTIONS_OPEN.dec()
+        writer.close()
+
+
+async def move_client_async(writer, name, room_id, opts, pending):
+    """
+    Async twin of move_client(). Anything the transport already read past
+    pending is lost on the way, as with a worker handoff.
+    """
+    msg = {"op": "client", "name": name, "room": room_id,
+           "info": handoff_info(opts, pending)}
+    if successor is not None and successor.send(msg, [writer.get_extra_info("socket")]):
+        eventlog.info("move", f"[>] {name} moved to pid {successor.pid} for room [{room_id}]",
+                      name=name, room=room_id, pid=successor.pid)
+        return
+    await send_msg_async(writer, SHUTDOWN_GOODBYE)
+
+
+async def enter_room_async(reader, writer, name, room_id, opts, pending=b""):
+    """Create or join room_id and relay until the chat ends."""
+    if draining:
+        return await move_client_async(writer, name, room_id, opts, pending)
+    if ROOM_SIZE > 2:
+        return await enter_group_async(reader, writer, name, room_id, opts, pending)
+
+    started = time.perf_counter()
+    # Broker calls are a quick round trip to the parent process; doing them
+    # inline keeps claim + create atomic with respect to this loop.
+    while broker is not None and not broker.claim(room_id):
+        info = handoff_info(opts, pending)
+        if broker.handoff(writer.get_extra_info("socket").fileno(), name, room_id, info):
+            return
+
+    rooms, _ = room_shard(room_id)
+    joining = room_id in rooms
+    if joining:
+        entry = rooms.pop(room_id)
+        if broker is not None:
+            broker.release(room_id)
+        ROOMS_WAITING.dec()
+        ROOMS_ACTIVE.inc()
+    else:
+        entry = {
+            "conn":         writer,
+            "name":         name,
+            "opts":         opts,
+            "event":        asyncio.Event(),
+            "partner_conn": None,
+            "partner_name": None,
+            "partner_opts": None,
+            "created_at":   time.time()
+        }
+        # The loop's own timer heap; expire_room() is safe to call here.
+        entry["timer"] = asyncio.get_running_loop().call_later(
+            TIMEOUT_SECONDS, expire_room, room_id, entry)
+        rooms[room_id] = entry
+        ROOMS_WAITING.inc()
+
+    if not joining:
+        mins = TIMEOUT_SECONDS // 60
+        await send_msg_async(writer, f"SYS:Room [{room_id}] created! Waiting for partner...",
+                             f"SYS:Room closes in {mins} mins if nobody joins.")
+
+        await entry["event"].wait()
+        ROOM_WAIT.observe(time.perf_counter() - started)
+
+        if entry["partner_conn"] is None:
+            if draining:
+                await move_client_async(writer, name, room_id, opts, pending)
+            else:
+                await send_msg_async(writer, "SYS:No one joined. Room closed. Goodbye!")
+            return
+
+        partner_conn = entry["partner_conn"]
+        partner_name = entry["partner_name"]
+        partner, member = entry["members"]
+
+        if "binary" not in opts:  # see enter_room()
+            await send_msg_async(writer, f"CONNECTED:{partner_name}")
+        PAIRING.observe(time.perf_counter() - started)
+
+    else:
+        entry["timer"].cancel()
+        partner_conn = entry["conn"]
+        partner_name = entry["name"]
+
+        # Both sides relay through the same two members, as in enter_room().
+        member  = AsyncMember(writer, name, opts)
+        partner = AsyncMember(partner_conn, partner_name, entry["opts"])
+        entry["members"]      = (member, partner)
+        entry["partner_conn"] = writer
+        entry["partner_name"] = name
+        entry["partner_opts"] = opts
+        entry["event"].set()
+
+        await send_msg_async(writer, f"CONNECTED:{partner_name}")
+        PAIRING.observe(time.perf_counter() - started)
+        # Also notify the waiting person
+        await send_msg_async(partner_conn, f"CONNECTED:{name}")
+
+    # Closing the partner's writer on the way out hands EOF to its relay,
+    # so both directions stop together without polling.
+    try:
+        if await relay_async(reader, member, lambda: (partner,), pending):
+            partner.say(b"SYS:Partner has left the chat. Goodbye!\n")
+        elif member.ended is not None:
+            partner.hang_up(member.ended)  # a timeout ends the chat for both
+    finally:
+        partner_conn.close()
+        if joining:
+            ROOMS_ACTIVE.dec()
+
+    eventlog.info("chat_end", f"[-] Chat ended: [{room_id}] {name} <-> {partner_name}",
+                  room=room_id, name=name, partner=partner_name)
+
+
+class AsyncMember:
+    """
+    asyncio twin of Member. The transport's write buffer is the outbox,
+    limited to QUEUE_HIGH/QUEUE_LOW, so drain() implements the block policy.
+    """
+
+    def __init__(self, writer, name, opts=()):
+        self.writer   = writer
+        self.name     = name
+        self.binary   = "binary" in opts
+        self.deflate  = "deflate" in opts
+        self.prefix   = msg_prefix(name)
+        self.zprefix  = msg_prefix(name, FRAME_ZMSG)
+        self.line_prefix = f"MSG:{name}:".encode()
+        self.batch    = "batch" in opts     # reads and relays in batches
+        self.dropping = False
+        self.since    = 0.0
+        self.active   = 0.0
+        self.timer    = None
+        self.ended    = None
+        writer.transport.set_write_buffer_limits(QUEUE_HIGH, QUEUE_LOW)
+
+    def push(self, *bufs):
+        """Write bufs as one buffer; False if the overflow policy refused it."""
+        data = bufs[0] if len(bufs) == 1 else b"".join(bufs)
+        transport = self.writer.transport
+        size = transport.get_write_buffer_size()
+        if size <= QUEUE_LOW:
+            self.dropping = False
+        elif self.dropping:
+            return False
+        if size and size + len(data) > QUEUE_HIGH and OVERFLOW_POLICY != "block":
+            if not self.dropping:
+                self.dropping = True
+                if OVERFLOW_POLICY == "disconnect":
+                    eventlog.warning("overflow", f"[!] {self.name} can't keep up; disconnecting.",
+                                     name=self.name, policy=OVERFLOW_POLICY)
+                else:
+                    eventlog.warning("overflow", f"[!] {self.name} can't keep up; dropping messages.",
+                                     name=self.name, policy=OVERFLOW_POLICY)
+            if OVERFLOW_POLICY == "disconnect":
+                transport.abort()
+            return False
+        self.writer.write(data)
+        return True
 
+    async def drained(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+
+    def say(self, data):
+        return self.push(*line_frames(data)) if self.binary else self.push(data)
+
+    def hang_up(self, line):
+        """Send line, then stop reading: relay_async() sees EOF. Once only."""
+        if self.ended is not None:
+            return
+        self.ended = line
+        self.say(line)
+        try:
+            self.writer.get_extra_info("socket").shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+
+async def enter_group_async(reader, writer, name, room_id, opts, pending):
+    started = time.perf_counter()
+    while broker is not None and not broker.claim(room_id):
+        info = handoff_info(opts, pending)
+        if broker.handoff(writer.get_extra_info("socket").fileno(), name, room_id, info):
+            return
+
+    rooms, _ = room_shard(room_id)
+    member = AsyncMember(writer, name, opts)
+    entry = rooms.get(room_id)
+    creating = entry is None
+    if creating:
+        entry = {
+            "members":    (member,),
+            "event":      asyncio.Event(),
+            "history":    History() if HISTORY_LINES else None,
+            "created_at": time.time()
+        }
+        entry["timer"] = asyncio.get_running_loop().call_later(
+            TIMEOUT_SECONDS, expire_room, room_id, entry)
+        rooms[room_id] = entry
+        ROOMS_WAITING.inc()
+    elif not group_add(entry, member):
+        member.push(f"SYS:Room [{room_id}] is full. Goodbye!\n".encode())
+        return
+
+    try:
+        if creating:
+            mins = TIMEOUT_SECONDS // 60
+            member.push(f"SYS:Room [{room_id}] created! Waiting for others...\n"
+                        f"SYS:Room closes in {mins} mins if nobody joins.\n".encode())
+            await entry["event"].wait()
+            ROOM_WAIT.observe(time.perf_counter() - started)
+            if len(entry["members"]) < 2:
+                if draining:
+                    await move_client_async(writer, name, room_id, opts, pending)
+                else:
+                    member.push(b"SYS:No one joined. Room closed. Goodbye!\n")
+                return
+        PAIRING.observe(time.perf_counter() - started)
+
+        await relay_async(reader, member, lambda: entry["members"], pending,
+                          entry["history"])
+    finally:
+        group_leave(room_id, entry, member)
+    eventlog.info("leave", f"[-] {name} left [{room_id}]", name=name, room=room_id)
+
+
+async def serve_asyncio(listener):
+    loop = asyncio.get_running_loop()
+    adopt = lambda conn, name, room_id, info: loop.call_soon_threadsafe(
+        loop.create_task, adopt_client_async(conn, name, room_id, info))
+    if broker is not None:
+        broker.listen(adopt)
+    if predecessor is not None:
+        handoff.adopt(predecessor, adopt)
+
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except NotImplementedError:
+            pass  # Windows: Ctrl-C stops the server without a drain
+    if hasattr(signal, "SIGUSR1"):
+        loop.add_signal_handler(signal.SIGUSR1, dump_histograms)
+
+    # start_server() listen()s again; keep our backlog.
+    server = await asyncio.start_server(handle_client_async, sock=listener,
+                                        backlog=LISTEN_BACKLOG)
+    await stop.wait()
     server.close()
+    await drain_async()
+
+
+async def drain_async():
+    """Async twin of drain(); pairs can't move live from this engine."""
+    deadline = time.monotonic() + DRAIN_SECONDS
+    begin_drain(False)
+    while CONNECTIONS_OPEN.value and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    if CONNECTIONS_OPEN.value:
+        cut_off()
+        deadline = time.monotonic() + 1
+        while CONNECTIONS_OPEN.value and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+    end_drain()
+
+
+def dump_histograms():
+    """SIGUSR1: log latency percentiles and save full histograms to STATS_DIR."""
+    for hist in metrics.histograms():
+        eventlog.info("stats", f"[*] {hist.summary()}", histogram=hist.name)
+    try:
+        path = metrics.dump(STATS_DIR)
+    except OSError as e:
+        eventlog.error("error", f"[ERROR] histogram dump: {e}", error=str(e))
+        return
+    eventlog.info("stats", f"[*] Histograms written to {path}", path=path)
+
+
+# The dump takes the eventlog and histogram locks, which the code a signal
+# interrupts may hold. So the SIGUSR1 handler only sets dump_wanted and
+# dump_on_request() does the work; asyncio runs it as a loop callback.
+dump_wanted = threading.Event()
+
+
+def dump_on_request():
+    while True:
+        dump_wanted.wait()
+        dump_wanted.clear()
+        dump_histograms()
+
+
+def run_engine(engine, server):
+    if engine == "asyncio":
+        try:
+            asyncio.run(serve_asyncio(server))
+        except KeyboardInterrupt:
+            eventlog.info("shutdown", "\n[*] Shutting down.")
+    else:
+        if hasattr(signal, "SIGUSR1"):
+            threading.Thread(target=dump_on_request, daemon=True).start()
+            signal.signal(signal.SIGUSR1, lambda signum, frame: dump_wanted.set())
+        signal.signal(signal.SIGINT, stop_accepting)
+        signal.signal(signal.SIGTERM, stop_accepting)
+        serve_threads(server)
+
+
+def run_worker(client, engine, metrics_port=None):
+    global broker
+    broker = client
+    if metrics_port is not None:
+        start_metrics(metrics_port + client.wid)
+    try:
+        run_engine(engine, open_listener(reuse_port=True))
+    finally:
+        eventlog.flush()  # workers leave with os._exit(), skipping atexit
+
+
+def start_metrics(port):
+    try:
+        metrics.serve(port)
+    except OSError as e:
+        print(f"[ERROR] metrics on port {port}: {e}")
+        return
+    print(f"[*] Metrics on http://0.0.0.0:{port}/metrics")
+
+
+def raise_fd_limit():
+    """Lift the soft open-files limit to the hard limit; each client is one fd."""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+
+def main():
+    global MAX_LINE_BYTES, ROOM_SIZE, QUEUE_HIGH, QUEUE_LOW, OVERFLOW_POLICY
+    global DRAIN_SECONDS, predecessor, admission, LISTEN_BACKLOG
+    global MSG_RATE, MSG_BURST, BYTE_RATE, BYTE_BURST
+    global HANDSHAKE_SECONDS, HANDSHAKE_MIN_RATE, IDLE_SECONDS, SESSION_SECONDS
+    global SOCKET_OPTIONS, BATCH_DELAY, HISTORY_LINES, HISTORY_BYTES, HISTORY_TOTAL
+    global STATS_DIR
+
+    parser = argparse.ArgumentParser(description="NormansChat server")
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default="threads",
+                        help="threads: one OS thread per connection (default); "
+                             "asyncio: all connections on one event loop")
+    parser.add_argument("--workers", type=int, default=1, metavar="N",
+                        help="fork N worker processes sharing the port with "
+                             "SO_REUSEPORT; rooms are paired across workers")
+    parser.add_argument("--max-line", type=int, default=MAX_LINE, metavar="BYTES",
+                        help=f"longest chat line accepted (default {MAX_LINE})")
+    parser.add_argument("--queue-high", type=int, default=QUEUE_HIGH, metavar="BYTES",
+                        help="outbound bytes queued per connection before "
+                             f"--overflow applies (default {QUEUE_HIGH})")
+    parser.add_argument("--queue-low", type=int, default=QUEUE_LOW, metavar="BYTES",
+                        help="queue size at which a paused sender resumes "
+                             f"(default {QUEUE_LOW})")
+    parser.add_argument("--overflow", choices=OVERFLOW_POLICIES, default=OVERFLOW_POLICY,
+                        help="what to do with messages for a connection whose "
+                             "queue is full (default block)")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="serve Prometheus metrics over HTTP on PORT; with "
+                             "--workers, worker i uses PORT+i")
+    parser.add_argument("--stats-dir", default=STATS_DIR, metavar="DIR",
+                        help="where SIGUSR1 writes histograms-<pid>.json "
+                             f"(default {STATS_DIR})")
+    parser.add_argument("--log-format", choices=("text", "json"), default="text",
+                        help="event log lines as text (default) or JSON objects")
+    parser.add_argument("--room-size", type=int, default=ROOM_SIZE, metavar="N",
+                        help="members per room (default 2: private pairs); "
+                             "larger values make every room a group chat")
+    parser.add_argument("--history", type=int, default=HISTORY_LINES, metavar="N",
+                        help="group rooms replay up to their last N messages to "
+                             f"whoever joins (default {HISTORY_LINES}; 0: off)")
+    parser.add_argument("--history-bytes", type=int, default=HISTORY_BYTES, metavar="BYTES",
+                        help=f"bytes of history per group room (default {HISTORY_BYTES})")
+    parser.add_argument("--history-total", type=int, default=HISTORY_TOTAL, metavar="BYTES",
+                        help="history kept over all rooms (default "
+                             f"{HISTORY_TOTAL >> 20} MiB)")
+    parser.add_argument("--max-conns", type=int, default=MAX_CONNECTIONS, metavar="N",
+                        help="connections served at once, per process; more are "
+                             f"told the server is busy (default {MAX_CONNECTIONS}, 0: no limit)")
+    parser.add_argument("--max-per-ip", type=int, default=MAX_PER_IP, metavar="N",
+                        help="connections at once from one address, per process "
+                             "(default 0: no limit)")
+    parser.add_argument("--max-handshakes", type=int, default=MAX_HANDSHAKES, metavar="N",
+                        help="connections still picking a name and room at once, "
+                             f"per process (default {MAX_HANDSHAKES}, 0: no limit)")
+    parser.add_argument("--accept-rate", type=float, default=ACCEPT_RATE, metavar="N",
+                        help="new connections a second, per process; bursts of up "
+                             "to N are let through (default 0: no limit)")
+    parser.add_argument("--msg-rate", type=float, default=MSG_RATE, metavar="N",
+                        help="chat lines a second one connection may send; faster "
+                             "senders are read from more slowly (default 0: no limit)")
+    parser.add_argument("--msg-burst", type=float, default=MSG_BURST, metavar="N",
+                        help="lines that may come at once within --msg-rate "
+                             "(default: one second's worth)")
+    parser.add_argument("--byte-rate", type=float, default=BYTE_RATE, metavar="BYTES",
+                        help="bytes a second one connection may send "
+                             "(default 0: no limit)")
+    parser.add_argument("--byte-burst", type=float, default=BYTE_BURST, metavar="BYTES",
+                        help="bytes that may come at once within --byte-rate "
+                             "(default: one second's worth)")
+    parser.add_argument("--handshake-timeout", type=float, default=HANDSHAKE_SECONDS,
+                        metavar="SECS", help="longest a client may take to pick a name "
+                        f"and room (default {HANDSHAKE_SECONDS}, 0: no limit)")
+    parser.add_argument("--handshake-min-rate", type=float, default=HANDSHAKE_MIN_RATE,
+                        metavar="BYTES", help="bytes a second a client must average "
+                        "while picking a name and room (default 0: no minimum)")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_SECONDS, metavar="SECS",
+                        help="end a chat when no message has gone either way for "
+                             f"this long (default {IDLE_SECONDS}: never)")
+    parser.add_argument("--session-timeout", type=float, default=SESSION_SECONDS,
+                        metavar="SECS", help="longest one chat may go on "
+                        "(default 0: no limit)")
+    parser.add_argument("--batch-delay", type=float, default=BATCH_DELAY * 1e6,
+                        metavar="USECS", help="for OPT:batch clients, how long to "
+                        "let lines pile up between reads (default "
+                        f"{BATCH_DELAY * 1e6:g}; up to about 1000 keeps chat interactive)")
+    parser.add_argument("--tcp-profile", choices=sorted(sockopts.PROFILES), default="chat",
+                        help="socket options for the listener and connections: "
+                             "chat (default) turns Nagle off and finds dead peers "
+                             "within minutes; os keeps the kernel defaults")
+    parser.add_argument("--tcp-opt", action="append", default=[], metavar="NAME=VALUE",
+                        help="override one option of --tcp-profile, e.g. keepidle=30, "
+                             "sndbuf=262144 or defer_accept=5; may be repeated "
+                             "(see sockopts.py)")
+    parser.add_argument("--backlog", type=int, default=LISTEN_BACKLOG, metavar="N",
+                        help="listen() backlog (default: net.core.somaxconn, "
+                             f"{LISTEN_BACKLOG} here)")
+    parser.add_argument("--drain-timeout", type=float, default=DRAIN_SECONDS, metavar="SECS",
+                        help="on SIGTERM or Ctrl-C, stop accepting and give chats "
+                             f"this long to end before closing them (default {DRAIN_SECONDS})")
+    parser.add_argument("--handoff", metavar="PATH",
+                        help="unix socket for zero-downtime restarts: a new server "
+                             "started with the same PATH takes over the listening "
+                             "socket and the clients of the running one")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.room_size < 2:
+        parser.error("--room-size must be at least 2")
+    if not 0 <= args.queue_low <= args.queue_high:
+        parser.error("--queue-low must be between 0 and --queue-high")
+    try:
+        SOCKET_OPTIONS = sockopts.profile(args.tcp_profile, args.tcp_opt)
+    except ValueError as e:
+        parser.error(f"--tcp-opt: {e}")
+    if args.handoff and args.workers > 1:
+        parser.error("--handoff needs a single process (no --workers)")
+    if args.handoff and not hasattr(socket, "send_fds"):
+        parser.error("--handoff is not supported on this platform")
+
+    MAX_LINE_BYTES  = args.max_line
+    ROOM_SIZE       = args.room_size
+    QUEUE_HIGH      = args.queue_high
+    QUEUE_LOW       = args.queue_low
+    OVERFLOW_POLICY = args.overflow
+    DRAIN_SECONDS   = args.drain_timeout
+    LISTEN_BACKLOG  = args.backlog
+    MSG_RATE        = args.msg_rate
+    MSG_BURST       = args.msg_burst
+    BYTE_RATE       = args.byte_rate
+    BYTE_BURST      = args.byte_burst
+    HANDSHAKE_SECONDS  = args.handshake_timeout
+    HANDSHAKE_MIN_RATE = args.handshake_min_rate
+    IDLE_SECONDS       = args.idle_timeout
+    SESSION_SECONDS    = args.session_timeout
+    BATCH_DELAY        = args.batch_delay / 1e6
+    HISTORY_LINES      = args.history
+    HISTORY_BYTES      = args.history_bytes
+    HISTORY_TOTAL      = args.history_total
+    STATS_DIR          = args.stats_dir
+    admission       = Admission(args.max_conns, args.max_per_ip, args.max_handshakes,
+                                args.accept_rate)
+    eventlog.FORMAT = args.log_format
+
+    print(BANNER)
+    raise_fd_limit()
+    print(f"[*] Listening on port 9999 ({args.engine} engine)...")
+    print(f"[*] TCP profile {args.tcp_profile}: {sockopts.describe(SOCKET_OPTIONS)}")
+    print(f"[*] Rooms expire after {TIMEOUT_SECONDS // 60} mins if empty.\n")
+
+    if args.workers > 1:
+        workers.run_workers(args.workers, lambda client: run_worker(
+            client, args.engine, args.metrics_port))
+    else:
+        if args.metrics_port is not None:
+            start_metrics(args.metrics_port)
+        server = None
+        withdraw = None
+        if args.handoff:
+            live = args.engine == "threads" and ROOM_SIZE == 2
+            taken = handoff.takeover(args.handoff, live)
+            if taken is not None:
+                server, pid, predecessor = taken
+                tune_listener(server)
+                print(f"[*] Took over the listener from pid {pid}.")
+        if server is None:
+            server = open_listener()
+        if args.handoff:
+            withdraw = handoff.offer(args.handoff, server, hand_over)
+        try:
+            run_engine(args.engine, server)
+        finally:
+            if withdraw is not None:
+                withdraw()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,100 @@
+"""
+TCP tuning for server.py: named profiles of socket options (--tcp-profile),
+with single options overridden by --tcp-opt NAME=VALUE.
+
+    nodelay        send small MSG: lines at once instead of waiting on Nagle
+    keepalive      probe idle connections, so dead peers are noticed ...
+    keepidle       ... after this many idle seconds,
+    keepintvl      probing every this many seconds,
+    keepcnt        and giving up after this many unanswered probes
+    user_timeout   drop a connection whose sent data stays unacknowledged
+                   this many seconds (TCP_USER_TIMEOUT)
+    sndbuf/rcvbuf  kernel buffer sizes in bytes (0: the kernel's autotuning)
+    defer_accept   listener: don't accept until the client sends something,
+                   or this many seconds pass. Our server speaks first, so
+                   this only helps clients that pipeline their name.
+    fastopen       listener: TCP Fast Open queue length
+
+Everything is set on the listening socket; Linux copies it to every
+accepted connection, so the hot accept path makes no extra syscalls.
+Elsewhere tune_conn() sets the per-connection options again.
+"""
+
+import socket
+import sys
+
+# name -> (level, option, listener only)
+OPTIONS = {
+    "nodelay":      ("IPPROTO_TCP", "TCP_NODELAY",      False),
+    "keepalive":    ("SOL_SOCKET",  "SO_KEEPALIVE",     False),
+    "keepidle":     ("IPPROTO_TCP", "TCP_KEEPIDLE",     False),
+    "keepintvl":    ("IPPROTO_TCP", "TCP_KEEPINTVL",    False),
+    "keepcnt":      ("IPPROTO_TCP", "TCP_KEEPCNT",      False),
+    "user_timeout": ("IPPROTO_TCP", "TCP_USER_TIMEOUT", False),
+    "sndbuf":       ("SOL_SOCKET",  "SO_SNDBUF",        False),
+    "rcvbuf":       ("SOL_SOCKET",  "SO_RCVBUF",        False),
+    "defer_accept": ("IPPROTO_TCP", "TCP_DEFER_ACCEPT", True),
+    "fastopen":     ("IPPROTO_TCP", "TCP_FASTOPEN",     True),
+}
+
+PROFILES = {
+    # Kernel defaults: Nagle on, dead peers found after about two hours.
+    "os": {},
+    # Interactive chat: lines go out at once; a silent dead peer is found
+    # in 60 + 6 * 10 seconds, one that stops acknowledging in 120.
+    "chat": {"nodelay": 1, "keepalive": 1, "keepidle": 60, "keepintvl": 10,
+             "keepcnt": 6, "user_timeout": 120},
+}
+
+INHERITED = sys.platform.startswith("linux")
+
+
+def profile(name, overrides=()):
+    """
+    The options of profile name with NAME=VALUE overrides applied. Raises
+    ValueError for an unknown profile, option or value.
+    """
+    if name not in PROFILES:
+        raise ValueError(f"unknown profile {name!r}")
+    opts = dict(PROFILES[name])
+    for item in overrides:
+        key, sep, value = item.partition("=")
+        key = key.strip().lower()
+        if key not in OPTIONS or not sep:
+            raise ValueError(f"expected NAME=VALUE with NAME one of {', '.join(OPTIONS)}")
+        try:
+            opts[key] = float(value) if key == "user_timeout" else int(value)
+        except ValueError:
+            raise ValueError(f"{key} wants a number, not {value!r}") from None
+    return opts
+
+
+def _set(sock, key, value):
+    level, option, _ = OPTIONS[key]
+    if key == "user_timeout":
+        value = int(value * 1000)  # the kernel wants milliseconds
+    if key in ("sndbuf", "rcvbuf") and not value:
+        return True  # leave autotuning alone
+    try:
+        sock.setsockopt(getattr(socket, level), getattr(socket, option), value)
+        return True
+    except (AttributeError, OSError):
+        return False
+
+
+def tune_listener(sock, opts):
+    """Apply opts to a listening socket; returns the names this platform refused."""
+    return [key for key, value in opts.items() if not _set(sock, key, value)]
+
+
+def tune_conn(conn, opts):
+    """Apply the per-connection opts to an accepted socket, where it didn't inherit them."""
+    if INHERITED:
+        return
+    for key, value in opts.items():
+        if not OPTIONS[key][2]:
+            _set(conn, key, value)
+
+
+def describe(opts):
+    return " ".join(f"{key}={value:g}" for key, value in opts.items()) or "kernel defaults"
@@ -0,0 +1,90 @@
+"""
+Deadline scheduler for the thread engine: one thread sleeping on a min-heap.
+
+Scheduling and cancelling are O(log n) / O(1); the thread wakes only when
+the earliest deadline is due (or a new earlier one is added), so a hundred
+thousand pending deadlines cost nothing while they wait. Callbacks run on
+the timer thread one after another and should be quick.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "heap")
+
+    def __init__(self, heap, deadline, callback, args):
+        self.heap      = heap
+        self.deadline  = deadline
+        self.callback  = callback
+        self.args      = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Same as asyncio's TimerHandle.cancel()."""
+        self.heap.cancel(self)
+
+
+class TimerHeap:
+    def __init__(self, name="timers"):
+        self._heap = []                 # (deadline, seq, Timer)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._cancelled = 0
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def call_at(self, deadline, callback, *args):
+        timer = Timer(self, deadline, callback, args)
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, next(self._seq), timer))
+            if self._heap[0][2] is timer:
+                self._cond.notify()
+        return timer
+
+    def cancel(self, timer):
+        """Cancel timer; harmless if it already fired or was cancelled."""
+        with self._cond:
+            if timer.cancelled or timer.callback is None:
+                return
+            timer.cancelled = True
+            self._cancelled += 1
+            # Cancelled entries are skipped lazily; rebuild once they are
+            # the majority so the heap stays proportional to live timers.
+            if self._cancelled > 64 and self._cancelled * 2 > len(self._heap):
+                self._heap = [e for e in self._heap if not e[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap) - self._cancelled
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    heap = self._heap
+                    while heap and heap[0][2].cancelled:
+                        heapq.heappop(heap)
+                        self._cancelled -= 1
+                    if not heap:
+                        self._cond.wait()
+                        continue
+                    delay = heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                _, _, timer = heapq.heappop(heap)
+                callback, args = timer.callback, timer.args
+                timer.callback = None   # fired; cancel() is now a no-op
+
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"[ERROR] timer callback {callback.__name__}: {e}")
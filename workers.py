@@ -0,0 +1,226 @@
+"""
+Multi-process mode for server.py.
+
+The parent forks N workers that each bind the same port with SO_REUSEPORT,
+so the kernel spreads accepted connections across processes. Sockets can't
+be shared between workers, so the parent keeps the room directory
+(room code -> worker id) and moves connections to the worker that holds
+the room by passing the fd over a unix socket (SCM_RIGHTS).
+
+Everything on the wire between parent and workers is one JSON object per
+SOCK_SEQPACKET message.
+"""
+
+import json
+import os
+import selectors
+import signal
+import socket
+import sys
+import threading
+import traceback
+
+MAX_MSG = 65536
+
+
+def send_json(sock, msg, fds=()):
+    data = json.dumps(msg).encode()
+    if fds:
+        socket.send_fds(sock, [data], list(fds))
+    else:
+        sock.send(data)
+
+
+def recv_json(sock, maxfds=1):
+    data, fds, _, _ = socket.recv_fds(sock, MAX_MSG, maxfds)
+    if not data:
+        return None, fds
+    return json.loads(data), fds
+
+
+class Broker:
+    """Parent side: owns the room directory and forwards handed-off fds."""
+
+    def __init__(self):
+        self.owners = {}    # room code -> worker id
+        self.push = {}      # worker id -> channel for handoffs to that worker
+        self.sel = selectors.DefaultSelector()
+        self.stopping = False
+
+    def add_worker(self, wid, req, push):
+        self.push[wid] = push
+        self.sel.register(req, selectors.EVENT_READ, wid)
+
+    def serve(self):
+        while self.push:
+            for key, _ in self.sel.select():
+                wid = key.data
+                try:
+                    msg, fds = recv_json(key.fileobj)
+                except OSError:
+                    msg, fds = None, []
+                if msg is None:
+                    self._drop_worker(wid, key.fileobj)
+                    continue
+                try:
+                    reply = self._handle(wid, msg, fds)
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+                try:
+                    send_json(key.fileobj, reply)
+                except OSError:
+                    self._drop_worker(wid, key.fileobj)
+
+    def _handle(self, wid, msg, fds):
+        op   = msg["op"]
+        room = msg.get("room")
+
+        if op == "claim":
+            return {"owner": self.owners.setdefault(room, wid)}
+
+        if op == "release":
+            if self.owners.get(room) == wid:
+                del self.owners[room]
+            return {"ok": True}
+
+        if op == "handoff":
+            owner = self.owners.get(room)
+            if owner is None or owner == wid or not fds:
+                return {"ok": False}
+            try:
+                send_json(self.push[owner], {"room": room, "name": msg["name"],
+                                         "info": msg.get("info", {})}, fds)
+            except OSError:
+                return {"ok": False}
+            return {"ok": True}
+
+        return {"error": f"unknown op {op!r}"}
+
+    def _drop_worker(self, wid, req):
+        if not self.stopping:
+            print(f"[!] Worker {wid} went away; dropping its rooms.")
+        self.sel.unregister(req)
+        req.close()
+        self.push.pop(wid).close()
+        for room in [r for r, w in self.owners.items() if w == wid]:
+            del self.owners[room]
+
+
+class BrokerClient:
+    """Worker side handle on the parent's room directory. Thread-safe."""
+
+    def __init__(self, wid, req, push):
+        self.wid  = wid
+        self.req  = req
+        self.push = push
+        self.lock = threading.Lock()
+
+    def _call(self, msg, fds=()):
+        with self.lock:
+            send_json(self.req, msg, fds)
+            reply, _ = recv_json(self.req)
+        if reply is None:
+            raise ConnectionError("room broker is gone")
+        return reply
+
+    def claim(self, room_id):
+        """True if room_id lives in this worker (it is claimed if free)."""
+        return self._call({"op": "claim", "room": room_id})["owner"] == self.wid
+
+    def release(self, room_id):
+        self._call({"op": "release", "room": room_id})
+
+    def handoff(self, fd, name, room_id, info=None):
+        """
+        Pass the client on fd to the worker holding room_id, along with a
+        JSON-able info dict of per-connection state. False if that room went
+        away meanwhile; the caller should claim again. On success the caller
+        just closes its copy of the socket.
+        """
+        msg = {"op": "handoff", "room": room_id, "name": name, "info": info or {}}
+        return self._call(msg, [fd])["ok"]
+
+    def listen(self, on_handoff):
+        """Call on_handoff(sock, name, room_id, info) for each client moved here."""
+        def run():
+            while True:
+                try:
+                    msg, fds = recv_json(self.push)
+                except OSError:
+                    msg, fds = None, []
+                if msg is None:
+                    # Parent died: shut this worker down the normal way.
+                    os.kill(os.getpid(), signal.SIGTERM)
+                    return
+                for fd in fds:
+                    on_handoff(socket.socket(fileno=fd), msg["name"], msg["room"], msg["info"])
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+def run_workers(n, worker_main):
+    """
+    Fork n workers running worker_main(client) and serve the room directory
+    in this process until they have all exited.
+    """
+    # SIGTERM behaves like Ctrl-C in the parent and in every worker. Don't
+    # rely on SIGINT alone: it is ignored in processes started in the
+    # background by a non-interactive shell.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    broker = Broker()
+    pids = []
+    for wid in range(n):
+        req_parent,  req_child  = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        push_parent, push_child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        pid = os.fork()
+        if pid == 0:
+            # Keep only this worker's ends of the channels.
+            req_parent.close()
+            push_parent.close()
+            for key in list(broker.sel.get_map().values()):
+                key.fileobj.close()
+            for ch in broker.push.values():
+                ch.close()
+            broker.sel.close()
+            code = 0
+            try:
+                worker_main(BrokerClient(wid, req_child, push_child))
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+        req_child.close()
+        push_child.close()
+        broker.add_worker(wid, req_parent, push_parent)
+        pids.append(pid)
+
+    print(f"[*] Started {n} workers: {', '.join(map(str, pids))}")
+    if hasattr(signal, "SIGUSR1"):
+        # Stats dumps are per process; pass the request on to every worker.
+        signal.signal(signal.SIGUSR1, lambda signum, frame: [
+            os.kill(pid, signal.SIGUSR1) for pid in pids])
+    try:
+        broker.serve()
+    except KeyboardInterrupt:
+        # The workers drain their chats; keep the room directory up for
+        # them until the last one has exited.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        broker.stopping = True
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        broker.serve()
+    for pid in pids:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass